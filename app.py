@@ -1,19 +1,59 @@
-# TODO: handle game in parallel channels
 import os
 import time
-import re
-import pymongo
-from urllib.parse import urlparse
-from datetime import date, datetime
-from slackclient import SlackClient
+import socket
+import asyncio
+import threading
+from pymongo import UpdateOne
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from directory import ChannelRegistry, UserDirectory
+from storage import GameRegistry, PlayerUnitOfWork
+from rtm import RTMRunner
+from messaging import ConversationCache, Outbox, RateLimiter, SlackSender
+from pairing import STRATEGIES as PAIRING_STRATEGIES
+from schema import collection_scans, ensure_indexes, migrate
+from cluster import Broadcast, ClusterWorker, Lease, WorkQueue
+from webapi import WebClient
+from bootstrap import Application, create_database, create_slack_client
+from scheduler import Job, Scheduler, daily, once
+from leaderboard import Leaderboard
+from records import Player
+from templates import Templates, to_blocks
+from metrics import Metrics
+from dedup import Deduplicator
+import intents
 
 # constants
 BOT_ID = os.environ.get("BOT_ID")
 BOT_NAME = 'questionbot'
-START_COMMAND = 'start'
-STOP_COMMAND = 'stop'
 NUMBERS = ('first', 'second', 'third')
+# number of players on the leaderboard, and of the players tied with the last one listed beyond it
+LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', 3))
+LEADERBOARD_TIED = int(os.environ.get('LEADERBOARD_TIED', 5))
+# hour of the daily pairing for games without their own
 DAILY_START_HOURS = 8
+# seconds after which the schedule is rebuilt, other workers could have changed the games
+SCHEDULE_REFRESH_DELAY = 5 * 60
+# number of events handled at the same time, events of one user or conversation are still handled in order
+HANDLER_CONCURRENCY = int(os.environ.get('HANDLER_CONCURRENCY', 8))
+# greedy: pair in order of rounds, maximum: pair as many players as possible (see pairing.py)
+PAIRING_STRATEGY = os.environ.get('PAIRING_STRATEGY', 'greedy')
+if PAIRING_STRATEGY not in PAIRING_STRATEGIES:
+    # a KeyError in select_for_pairing would be swallowed by the message handler and nobody would be paired
+    raise ValueError('Unknown PAIRING_STRATEGY!', PAIRING_STRATEGY, sorted(PAIRING_STRATEGIES))
+# number of work queue partitions shared by the workers, 0 runs a single worker without the work queue
+CLUSTER_PARTITIONS = int(os.environ.get('CLUSTER_PARTITIONS', 0))
+# seconds between trying to become the leader and trying to lock a game for pairing
+LEADER_RETRY_DELAY = 5
+PAIRING_RETRY_DELAY = 0.1
+# seconds between logging the event handling statistics
+STATS_LOG_DELAY = 5 * 60
+# local port of the Prometheus metrics endpoint, not served if unset
+METRICS_PORT = os.environ.get('METRICS_PORT')
+# send the end of game announcement as Block Kit sections as well
+BLOCK_KIT = os.environ.get('BLOCK_KIT') == '1'
 
 MSG_START_GAME = 'Hi @channel! Let\'s start a new round, please check your private messages!'
 MSG_WELCOME = ('Hi! I am questionbot and I invite you to play a little game which furthermore will '
@@ -22,7 +62,8 @@ MSG_WELCOME = ('Hi! I am questionbot and I invite you to play a little game whic
                'You will be asked to set up three statements and corresponding true/false answers and '
                'after that you will be paired with one of your classmates who is also playing this '
                'game. Each of you will make a guess and after the end of that round you will be paired '
-               'with another classmate until there are no one left or the time is up.')
+               'with another classmate until there are no one left or the time is up. Say "rank" to me any '
+               'time to see where you are on the leaderboard.')
 MSG_SETUP = ('Please give me three statements and corresponding true/false answers in connection with this '
              'week\'s material!')
 # You can type "cancel" anytime to opt-out of the game for that week.
@@ -34,7 +75,8 @@ MSG_ANSWER_REPEAT = ('Sorry, I didn\'t get that. Please, tell me again the answe
                      '(true/false)')
 MSG_SETUP_DONE = ('Okay, you\'re set up. Please wait until other players join the game, I will pair you up with them. '
                   'Stay tuned! ;)')
-MSG_ADMIN_UNKNOWN_COMMAND = 'Sorry, I didn\'t recognize any command. Use "start [#channel]" to start a game!'
+MSG_ADMIN_UNKNOWN_COMMAND = ('Sorry, I didn\'t recognize any command. Use "start [#channel]" to start a game or '
+                             '"stop [#channel]" to stop one!')
 MSG_ADMIN_STARTING_GAME_CHANNEL = 'Starting game in channel #{channel}.'
 MSG_ADMIN_STARTING_GAME_TEAM = 'Starting game for the whole team.'
 MSG_ADMIN_CONFIRM_START_TEAM = 'Are you sure you want to start a game for the whole team? (yes/no)'
@@ -43,6 +85,7 @@ MSG_ADMIN_CONFIRM_START_CANCEL = 'Game start cancelled.'
 MSG_ADMIN_STOPPING_GAME = 'Stopping game.'
 MSG_ADMIN_CONFIRM_STOP = 'Are you sure you want to end the game? (yes/no)'
 MSG_ADMIN_CONFIRM_STOP_CANCEL = 'Game stop cancelled.'
+MSG_ADMIN_WHICH_GAME = 'There are several games running. Use "stop #channel" to tell me which one to stop!'
 MSG_NO_GAME_ONGOING = ('Currently there isn\'t any game ongoing. Please wait for the next round or '
                        'contact an admin!')
 MSG_NOT_YOUR_TURN = 'It\'s not your turn now. Please, wait until your opponent finishes!'
@@ -57,46 +100,24 @@ MSG_ROUND_ANSWER_INCORRECT = '@{user_name}: Sorry, you\'re wrong. Maybe next tim
 MSG_ROUND_END = ('Okay, that\'s it. Thanks guys for the questions and the answers. We\'ll meet tomorrow '
                  '(if there are any players left and the game is still on).')
 MSG_ROUND_POINTS = 'Huh, it was great! You have {points} points at the end of the round.'
-MSG_END_GAME = ('Dear @channel! The question game has ended. Players with the top points are:\n'
-                '1. @{player_1}: {points_1} points\n'
-                '2. @{player_2}: {points_2} points\n'
-                '3. @{player_3}: {points_3} points\n')
+MSG_END_GAME = 'Dear @channel! The question game has ended. Players with the top points are:\n{leaderboard}\n'
+MSG_LEADERBOARD_LINE = '{rank}. @{name}: {points} points'
+MSG_LEADERBOARD_MORE = '... and {count} more tied'
+MSG_RANK = 'You are #{rank} with {points} points. Players with the top points are:\n{leaderboard}'
+# the default message templates by name (MSG_ROUND_END is round_end), they can be overridden in Mongo (see templates.py)
+TEMPLATES = {name[len('MSG_'):].lower(): text for name, text in list(globals().items()) if name.startswith('MSG_')}
 
 
 def slack_api(method, **kwargs):
-    api_call = slack_client.api_call(method, **kwargs)
-    if api_call.get('ok'):
-        return api_call
-    else:
-        raise ValueError('Connection error!', api_call.get('error'), api_call.get('args'))
+    # rate limits and transient failures are retried, the other errors raise ValueError
+    return web_client.call(method, **kwargs)
 
 
 def get_channel_type(channel_id):
     '''
-        Determines the channel type based on channel id.
-
-            :param channel_id: the id of the channel
-            :type channel_id: str
-            :return: returns the type of the channel
-                pub: public channel (channel)
-                priv: private channel (group)
-                dm: direct message channel (im)
-                gdm: group dm message channel (mpim)
-            :rtype: str
+        Determines the channel type based on channel id, see ChannelRegistry.get_type.
     '''
-    channel = slack_client.api_call('channels.info', channel=channel_id)
-    group = slack_client.api_call('groups.info', channel=channel_id)
-    if channel.get('ok'):
-        return 'pub'
-    elif group.get('ok'):
-        if group.get('group').get('is_mpim'):
-            return 'gdm'
-        else:
-            return 'priv'
-    elif channel.get('error') == 'channel_not_found' and group.get('error') == 'channel_not_found':
-        return 'dm'
-    else:
-        raise ValueError('Connection error!', channel.get('error'), group.get('error'))
+    return channel_registry.get_type(channel_id)
 
 
 def log(scope, message):
@@ -104,40 +125,39 @@ def log(scope, message):
 
 
 def is_admin(user_id):
-    api_call = slack_api('users.info', user=user_id)
-    user = api_call.get('user')
-    if 'is_admin' in user and user.get('is_admin') is True:
-        return True
-    else:
-        return False
+    return user_directory.is_admin(user_id)
 
 
 def send_im(user_id, message):
-    api_call = slack_api('im.open', user=user_id)
-    channel_id = api_call.get('channel').get('id')
-    slack_api('chat.postMessage', channel=channel_id, text=message, username=BOT_NAME, parse='full')
+    outbox.send([user_id], message, username=BOT_NAME, parse='full')
 
 
 def send_mpim(user_ids, message):
-    api_call = slack_api('mpim.open', users=','.join(user_ids))
-    channel_id = api_call.get('group').get('id')
-    send_channel_message(channel_id, message)
-    return channel_id
+    return outbox.send(user_ids, message, username=BOT_NAME, parse='full')
 
 
-def send_channel_message(channel_id, message):
-    slack_api('chat.postMessage', channel=channel_id, text=message, username=BOT_NAME, parse='full')
+def send_channel_message(channel_id, message, blocks=None):
+    if blocks is None:
+        outbox.post(channel_id, message, username=BOT_NAME, parse='full')
+    else:
+        # the text is the notification and fallback of the blocks
+        outbox.post(channel_id, message, username=BOT_NAME, parse='full', blocks=blocks)
+
+
+def on_post():
+    metrics.replied()
+    application.replied()
 
 
 def get_player_list(channel_id):
-    users = slack_api("users.list").get('members')
+    users = user_directory.users()
     if channel_id is not None:
-        channel = slack_client.api_call('channels.info', channel=channel_id)
-        group = slack_client.api_call('groups.info', channel=channel_id)
+        channel = web_client.api_call('channels.info', channel=channel_id)
+        group = web_client.api_call('groups.info', channel=channel_id)
         if channel.get('ok'):
-            users_in_channel = channel.get('channel').get('members')
+            users_in_channel = set(channel.get('channel').get('members'))
         elif group.get('ok'):
-            users_in_channel = group.get('group').get('members')
+            users_in_channel = set(group.get('group').get('members'))
         elif channel.get('error') == 'channel_not_found' and group.get('error') == 'channel_not_found':
             raise ValueError('Channel is dm type.')
         else:
@@ -158,210 +178,308 @@ def get_player_list(channel_id):
 
 
 def get_channel_id_by_name(channel_name):
-    channels = slack_api('channels.list').get('channels')
-    for channel in channels:
-        if channel['name'] == channel_name:
-            return channel['id']
+    return channel_registry.get_id(channel_name)
 
-    groups = slack_api('groups.list').get('groups')
-    for group in groups:
-        if group['name'] == channel_name:
-            return group['id']
 
-    return None
+def format_leaderboard(ranked, more, game_id=None):
+    rows = [{'rank': rank, 'name': name, 'points': points} for rank, name, points in ranked]
+    lines = templates.render_lines('leaderboard_line', rows, game_id)
+    # a tie of the whole channel would mention everyone
+    return lines + '\n' + render('leaderboard_more', game_id, count=more) if more else lines
+
+
+def game_language(game_id):
+    game = games.games.get(game_id)
+    return game.language if game is not None else None
+
+
+def render(name, game_id=None, **values):
+    '''
+        Renders the message template of the game, see Templates.get.
+    '''
+    return templates.render(name, game_id, **values)
+
+
+def is_user_message(event):
+    '''
+        Tells whether a message event was written by a user other than the bot, only those are handled.
+    '''
+    return (
+        'user' in event and 'text' in event and event['user'] != BOT_ID and 'bot_id' not in event
+        and event.get('subtype') not in ('bot_message', 'message_changed', 'message_deleted', 'message_replied')
+    )
+
+
+def observe_directory(event):
+    '''
+        Keeps the caches of the channels and users current, every worker applies these events.
+    '''
+    channel_registry.observe(event)
+    user_directory.observe(event)
+
+
+def is_directory_event(event):
+    return event.get('type') in ChannelRegistry.EVENTS or event.get('type') in UserDirectory.EVENTS
 
 
 def parse_slack_output(slack_rtm_output):
     output_list = slack_rtm_output
     if output_list and len(output_list) > 0:
         for output in output_list:
-            if output and 'type' in output and output['type'] == 'message':
-                # TODO: include user name and channel name as well to be more readable
-                if all(key in output for key in ['text', 'channel', 'user', 'subtype']):
-                    log('API', {key: output[key] for key in ['text', 'channel', 'user', 'subtype']})
-                elif all(key in output for key in ['text', 'channel', 'user']):
-                    log('API', {key: output[key] for key in ['text', 'channel', 'user']})
-                else:
-                    log('API', {key: output[key] for key in ['text', 'channel']})
-                handle_message_event(output)
+            if output and 'type' in output:
+                observe_directory(output)
+                if output['type'] == 'message':
+                    # TODO: include user name and channel name as well to be more readable
+                    if all(key in output for key in ['text', 'channel', 'user', 'subtype']):
+                        log('API', {key: output[key] for key in ['text', 'channel', 'user', 'subtype']})
+                    elif all(key in output for key in ['text', 'channel', 'user']):
+                        log('API', {key: output[key] for key in ['text', 'channel', 'user']})
+                    else:
+                        log('API', {key: output[key] for key in ['text', 'channel']})
+                    if not is_user_message(output):
+                        # the bot's own posts, edits and other bots get no reply, nor a deduplication key
+                        continue
+                    if not deduplicator.claim(output):
+                        log('EVENT', 'Duplicate of {} skipped.'.format(Deduplicator.key(output)))
+                        continue
+                    metrics.start_event(output)
+                    try:
+                        with metrics.timer('questionbot_event_handling_seconds', ()), outbox.collect():
+                            handle_message_event(output)
+                    except Exception:
+                        # the event can be handled again when it is retried
+                        deduplicator.release(output)
+                        raise
+
+
+def do_daily(game_id):
+    log('CACHE', 'Channel registry: {}'.format(channel_registry.stats()))
+    log('CACHE', 'User directory: {}'.format(user_directory.stats()))
+    # other workers could have changed the games since the last load, the templates could have been edited
+    games.load()
+    templates.load()
+    if games.get(game_id).status == 'game':
+        with outbox.collect():
+            select_for_pairing(game_id)
+
+
+def end_game(game_id):
+    game = games.get(game_id)
+    if game.status in ('game', 'confirm_stop'):
+        log('PROGRAM', 'Game in {} reached its deadline.'.format(game_id))
+        stop_game(game)
+
+
+def restart_game(game_id):
+    game = games.get(game_id)
+    if game.status == 'wait':
+        log('PROGRAM', 'Restarting game in {}.'.format(game_id))
+        start_game(game)
+
+
+def scheduled_jobs():
+    '''
+        Returns the jobs of the games: the daily pairing and the deadline of the running games and the next start of
+        the recurring ones.
 
+            :rtype: list
+    '''
+    if games.shared:
+        games.load_games()
+
+    jobs = []
+    for game in games.with_status('game', 'confirm_stop'):
+        try:
+            tz = game.tzinfo()
+        except (KeyError, ValueError):
+            log('PROGRAM', 'Unknown time zone {} of game {}, using local time.'.format(game.timezone, game.channel_id))
+            tz = None
+        hour = DAILY_START_HOURS if game.daily_hour is None else game.daily_hour
+        jobs.append(Job('daily:' + game.channel_id, daily(hour, tz), partial(do_daily, game.channel_id)))
+        if game.deadline() is not None:
+            jobs.append(Job('end:' + game.channel_id, once(game.deadline()), partial(end_game, game.channel_id)))
+    for game in games.with_status('wait'):
+        if game.next_start() is not None:
+            jobs.append(
+                Job('start:' + game.channel_id, once(game.next_start()), partial(restart_game, game.channel_id))
+            )
+    return jobs
 
-def do_daily():
-    status = db['settings'].find_one({'name': 'status'})
-    if status is not None and status['value'] == 'game':
-        select_for_pairing()
 
+def find_admin_game(user_id, intent, channel_type):
+    '''
+        Determines the game an admin message refers to.
 
-def handle_message_event(event):
+            :type intent: intents.Intent
 
-    try:
-        user_id = event['user']
-        # if admin
-        if is_admin(user_id):
-            # if in wait status
-            if db['settings'].find_one({'name': 'status'})['value'] == 'wait':
-                # send confirmation message for starting a game
-                if START_COMMAND in event['text'].lower() and get_channel_type(event['channel']) == 'dm':
-                    if '#' in event['text']:
-                        mentioned_channels = re.search('<#(\w*)\|([a-zA-Z0-9_-]*)\>', event['text'])
-                        if mentioned_channels is None:
-                            mentioned_channels = re.search('#([a-zA-Z0-9_-]*)', event['text'])
-                            db['settings'].update_one(
-                                {'name': 'channel_name'},
-                                {'$set': {'value': mentioned_channels.group(1)}}, upsert=True
-                            )
-                            db['settings'].update_one(
-                                {'name': 'channel_id'},
-                                {
-                                    '$set': {
-                                        'value':
-                                            get_channel_id_by_name(
-                                                db['settings'].find_one({'name': 'channel_name'})['value']
-                                            )
-                                    }
-                                },
-                                upsert=True
-                            )
-                        else:
-                            db['settings'].update_one(
-                                {'name': 'channel_id'},
-                                {'$set': {'value': mentioned_channels.group(1)}},
-                                upsert=True
-                            )
-                            db['settings'].update_one(
-                                {'name': 'channel_name'},
-                                {'$set': {'value': mentioned_channels.group(2)}},
-                                upsert=True
-                            )
-                        send_im(
-                            user_id,
-                            MSG_ADMIN_CONFIRM_START_CHANNEL.format(
-                                channel=db['settings'].find_one({'name': 'channel_name'})['value']
-                            )
-                        )
+            :return: the game waiting for the admin's confirmation, the mentioned game or the game implied by the
+                command, None if there isn't any (a direct message without a command is answered with the usage)
+            :rtype: GameState
+    '''
+    game = games.pending_confirmation(user_id)
+    if game is not None or channel_type != 'dm':
+        return game
+
+    if not intent.start and not intent.stop:
+        send_im(user_id, render('admin_unknown_command'))
+        return None
+
+    if intent.channel_id is not None:
+        return games.get(intent.channel_id, intent.channel_name)
+    if intent.channel_name is not None:
+        channel_id = get_channel_id_by_name(intent.channel_name)
+        return games.get(channel_id, intent.channel_name) if channel_id is not None else None
+
+    if intent.start:
+        channel_id = get_channel_id_by_name('general')
+        return games.get(channel_id, 'general') if channel_id is not None else None
+
+    # stopping without a channel is only clear with a single running game
+    running = games.with_status('game')
+    if len(running) == 1:
+        return running[0]
+    elif len(running) > 1:
+        send_im(user_id, render('admin_which_game'))
+    return None
 
-                    else:
-                        channel_id = get_channel_id_by_name('general')
-                        db['settings'].update_one(
-                            {'name': 'channel_id'},
-                            {'$set': {'value': channel_id}}, upsert=True
-                        )
-                        db['settings'].update_one(
-                            {'name': 'channel_name'},
-                            {'$set': {'value': 'general'}}, upsert=True
-                        )
-                        send_im(user_id, MSG_ADMIN_CONFIRM_START_TEAM)
-
-                    db['settings'].update_one(
-                        {'name': 'status'},
-                        {'$set': {'value': 'confirm_start'}}, upsert=True
-                    )
-                else:
-                    # do nothing
-                    pass
 
-            # start game if confirmed
-            elif db['settings'].find_one({'name': 'status'})['value'] == 'confirm_start':
-                if get_channel_type(event['channel']) == 'dm':
-                    if 'yes' in event['text'].lower():
-                        if db['settings'].find_one({'name': 'channel_name'})['value'] == 'general':
-                            send_im(user_id, MSG_ADMIN_STARTING_GAME_TEAM)
-                        else:
-                            send_im(
-                                user_id,
-                                MSG_ADMIN_STARTING_GAME_CHANNEL.format(
-                                    channel=db['settings'].find_one({'name': 'channel_name'})['value']
-                                )
-                            )
-                        start_game(db['settings'].find_one({'name': 'channel_id'})['value'])
-                    else:
-                        send_im(user_id, MSG_ADMIN_CONFIRM_START_CANCEL)
-                        db['settings'].update_one(
-                            {'name': 'status'},
-                            {'$set': {'value': 'wait'}}, upsert=True
-                        )
-                else:
-                    # do nothing
-                    pass
+def handle_admin_wait(user_id, intent, channel_type, game):
+    # send confirmation message for starting a game
+    if intent.start and channel_type == 'dm':
+        if game.channel_name == 'general':
+            message = render('admin_confirm_start_team', game.channel_id)
+        else:
+            message = render('admin_confirm_start_channel', game.channel_id, channel=game.channel_name)
 
-            # send confirmation message for stopping a game
-            elif db['settings'].find_one({'name': 'status'})['value'] == 'game':
-                if STOP_COMMAND in event['text'].lower() and get_channel_type(event['channel']) == 'dm':
-                    send_im(user_id, MSG_ADMIN_CONFIRM_STOP)
-                    db['settings'].update_one(
-                        {'name': 'status'},
-                        {'$set': {'value': 'confirm_stop'}}, upsert=True
-                    )
-                else:
-                    # do nothing
-                    pass
+        if game.transition('confirm_start', admin=user_id):
+            send_im(user_id, message)
 
-            # stop game if confirmed
-            elif db['settings'].find_one({'name': 'status'})['value'] == 'confirm_stop':
-                if get_channel_type(event['channel']) == 'dm':
-                    if 'yes' in event['text'].lower():
-                        send_im(user_id, MSG_ADMIN_STOPPING_GAME)
-                        stop_game()
-                    else:
-                        send_im(user_id, MSG_ADMIN_CONFIRM_STOP_CANCEL)
-                        db['settings'].update_one(
-                            {'name': 'status'},
-                            {'$set': {'value': 'game'}}, upsert=True
-                        )
-                else:
-                    # do nothing
-                    pass
 
+def handle_admin_confirm_start(user_id, intent, channel_type, game):
+    # start game if confirmed
+    if channel_type == 'dm':
+        if intent.confirm:
+            if game.channel_name == 'general':
+                send_im(user_id, render('admin_starting_game_team', game.channel_id))
             else:
-                send_im(user_id, MSG_ADMIN_UNKNOWN_COMMAND)
+                send_im(user_id, render('admin_starting_game_channel', game.channel_id, channel=game.channel_name))
+            start_game(game)
+        elif game.transition('wait'):
+            send_im(user_id, render('admin_confirm_start_cancel', game.channel_id))
+
+
+def handle_admin_game(user_id, intent, channel_type, game):
+    # send confirmation message for stopping a game
+    if intent.stop and channel_type == 'dm':
+        if game.transition('confirm_stop', admin=user_id):
+            send_im(user_id, render('admin_confirm_stop', game.channel_id))
+
+
+def handle_admin_confirm_stop(user_id, intent, channel_type, game):
+    # stop game if confirmed
+    if channel_type == 'dm':
+        if intent.confirm:
+            send_im(user_id, render('admin_stopping_game', game.channel_id))
+            stop_game(game)
+        elif game.transition('game'):
+            send_im(user_id, render('admin_confirm_stop_cancel', game.channel_id))
+
+
+# admin message handlers by game status
+ADMIN_HANDLERS = {
+    'wait': handle_admin_wait,
+    'confirm_start': handle_admin_confirm_start,
+    'game': handle_admin_game,
+    'confirm_stop': handle_admin_confirm_stop,
+}
+
+
+def handle_message_event(event):
+
+    try:
+        user_id = event['user']
+        channel_type = get_channel_type(event['channel'])
+        intent = intents.parse(event['text'])
+        # if admin
+        if is_admin(user_id):
+            if games.shared:
+                # other workers could have changed the games
+                games.load_games()
+            game = find_admin_game(user_id, intent, channel_type)
+            if game is not None:
+                ADMIN_HANDLERS[game.status](user_id, intent, channel_type, game)
 
         # if player
         else:
-            # setup
-            if db['players'].find_one({'id': user_id})['status'] == 'setup' and \
-                    get_channel_type(event['channel']) == 'dm':
-                handle_setup(user_id, event['text'])
-            # play
-            elif db['players'].find_one({'id': user_id})['status'] == 'play' and \
-                    get_channel_type(event['channel']) == 'gdm':
-                send_im(user_id, MSG_NOT_YOUR_TURN)
-            # answer
-            elif db['players'].find_one({'id': user_id})['status'] == 'answer':
-                if event['channel'] == db['players'].find_one({'id': user_id})['play_channel']:
-                    handle_answer(user_id, event['text'])
+            player_st = games.find_player(user_id, event['channel'])
+            if player_st is None:
+                return
+
+            players = PlayerUnitOfWork(db['players'], player_st['game'])
+            players.add(player_st)
+            try:
+                # ranking
+                if intent.rank and channel_type == 'dm':
+                    ranking = leaderboard.ranking(player_st['game'])
+                    ranked, more = ranking.top(LEADERBOARD_SIZE, LEADERBOARD_TIED)
+                    send_im(user_id, render(
+                        'rank',
+                        player_st['game'],
+                        rank=ranking.rank(user_id),
+                        points=ranking.points.get(user_id, 0),
+                        leaderboard=format_leaderboard(ranked, more, player_st['game'])
+                    ))
+                # setup
+                elif player_st['status'] == 'setup' and channel_type == 'dm':
+                    handle_setup(user_id, intent, players)
+                # play
+                elif player_st['status'] == 'play' and channel_type == 'gdm':
+                    send_im(user_id, render('not_your_turn', player_st['game']))
+                # answer
+                elif player_st['status'] == 'answer':
+                    if event['channel'] == player_st['play_channel']:
+                        handle_answer(user_id, intent, players)
+                    else:
+                        send_im(user_id, render('say_in_mpim', player_st['game']))
+                elif player_st['status'] == 'idle' and channel_type == 'dm':
+                    send_im(user_id, render('no_game_ongoing', player_st['game']))
                 else:
-                    send_im(user_id, MSG_SAY_IN_MPIM)
-            elif db['players'].find_one({'id': user_id})['status'] == 'idle' and \
-                    get_channel_type(event['channel']) == 'dm':
-                send_im(user_id, MSG_NO_GAME_ONGOING)
-            else:
-                # do nothing
-                pass
+                    # do nothing
+                    pass
+            finally:
+                if not players.flush():
+                    # a duplicate of the event changed the player first and got the replies
+                    outbox.discard()
+                    log('EVENT', 'Stale event of {} in {} dropped.'.format(user_id, event['channel']))
 
     except KeyError as e:
         print(e)
 
 
 # TODO: handle players joining the channel after game start
-def start_game(channel_id):
-    db['settings'].update_one(
-        {'name': 'status'},
-        {'$set': {'value': 'game'}}, upsert=True
-    )
-
-    # drop previous players collection
-    db['players'].drop()
-
-    send_channel_message(channel_id, MSG_START_GAME)
-
-    players = get_player_list(channel_id)
-    for player in players:
-        # save player status
-        # we need player id in key and in value as well
-        db['players'].update_one(
-            {'id': player['id']},
+def start_game(game):
+    if not game.transition('game', started_at=datetime.now(timezone.utc)):
+        return
+    scheduler.reschedule()
+    channel_id = game.channel_id
+
+    # remove previous players, dropping the collection would drop its indexes too
+    db['players'].delete_many({'game': channel_id})
+
+    send_channel_message(channel_id, render('start_game', channel_id))
+
+    players = list(get_player_list(channel_id))
+    if len(players) == 0:
+        return
+
+    # save player statuses
+    # we need player id in key and in value as well
+    db['players'].bulk_write([
+        UpdateOne(
+            {'game': channel_id, 'id': player['id']},
             {
                 '$set': {
+                    'game': channel_id,
                     'id': player['id'],
                     'name': player['name'],
                     'status': 'setup',
@@ -377,43 +495,43 @@ def start_game(channel_id):
             },
             upsert=True
         )
-
-        player_st = db['players'].find_one({'id': player['id']})
-
-        # send initial messages to player
-        send_im(player['id'], MSG_WELCOME)
-        send_im(player['id'], MSG_SETUP)
-        send_im(player['id'], MSG_QUESTION.format(number=NUMBERS[len(player_st['questions'])]))
+        for player in players
+    ])
+    games.add_players(channel_id, [player['id'] for player in players])
+    leaderboard.reset(channel_id, players)
+
+    # send initial messages to players in one message each, after the announcement
+    outbox.flush()
+    failed = slack_sender.send_ims(
+        [player['id'] for player in players],
+        '\n\n'.join([
+            render('welcome', channel_id),
+            render('setup', channel_id),
+            render('question', channel_id, number=NUMBERS[0])
+        ]),
+        username=BOT_NAME,
+        parse='full'
+    )
+    metrics.replied()
+    for user_id, error in failed.items():
+        log('PROGRAM', 'Could not send the initial message to {}: {}'.format(user_id, error))
 
 
-# TODO: handle ending game with passing deadline
-# TODO: making recurring games
-def stop_game():
+def stop_game(game):
 
     # set game and player statuses
-    db['settings'].update_one({'name': 'status'}, {'$set': {'value': 'wait'}}, upsert=True)
-    for player in db['players'].find():
-        db['players'].update_one({'id': player['id']}, {'$set': {'status': 'idle'}}, upsert=True)
-
-    # get top 3 players by points
-    players = list(db['players'].find())
-    players.sort(key=lambda p: p['points'], reverse=True)
+    if not game.transition('wait', ended_at=datetime.now(timezone.utc)):
+        return
+    scheduler.reschedule()
+    db['players'].update_many({'game': game.channel_id}, {'$set': {'status': 'idle'}})
 
     # send leaderboard
-    send_channel_message(
-        db['settings'].find_one({'name': 'channel_id'})['value'],
-        MSG_END_GAME.format(
-            player_1=players[0]['name'] if len(players) > 0 else '-',
-            points_1=players[0]['points'] if len(players) > 0 else '-',
-            player_2=players[1]['name'] if len(players) > 1 else '-',
-            points_2=players[1]['points'] if len(players) > 1 else '-',
-            player_3=players[2]['name'] if len(players) > 2 else '-',
-            points_3=players[2]['points'] if len(players) > 2 else '-'
-        )
-    )
+    ranked, more = leaderboard.top(game.channel_id, LEADERBOARD_SIZE, LEADERBOARD_TIED)
+    message = render('end_game', game.channel_id, leaderboard=format_leaderboard(ranked, more, game.channel_id))
+    send_channel_message(game.channel_id, message, blocks=to_blocks(message) if BLOCK_KIT else None)
 
 
-def select_for_pairing():
+def select_for_pairing(game_id):
     """
         Pairing rules:
         - player must be in "play" state
@@ -424,269 +542,389 @@ def select_for_pairing():
         - nobody can play with themselves
     """
 
-    # filter for status and last_round, sort by rounds
-    players = list(
-        db['players'].find(
-            {
-                'status': 'ready',
-                'last_round': {
-                    # should be datetime object, because date cannot be encoded as BSON
-                    '$ne': datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
-                }
-            }
-        ).sort(
-            [
-                ('rounds', -1)
-            ]
-        )
-    )
-
-    # search for a suitable pair
-    for player in players:
-        candidates = list(
-            db['players'].find(
+    players = PlayerUnitOfWork(db['players'], game_id)
+    with pairing_mutex(game_id):
+        # filter for status and last_round, sort by rounds
+        # only the fields of the pairing are read, the whole documents are loaded for the paired players only
+        pool = [
+            Player.for_pairing(player)
+            for player in db['players'].find(
                 {
+                    'game': game_id,
                     'status': 'ready',
                     'last_round': {
                         # should be datetime object, because date cannot be encoded as BSON
                         '$ne': datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
-                    },
-                    'id': {
-                        '$nin': player['opponents'] + [player['id']]
                     }
-                }
+                },
+                Player.PAIRING_PROJECTION
+            ).sort(
+                [
+                    ('rounds', 1),
+                    ('_id', 1)
+                ]
             )
-        )
-
-        if len(candidates) > 0:
-            candidate = candidates[0]
+        ]
+        pairs = PAIRING_STRATEGIES[PAIRING_STRATEGY](pool)
+        del pool
+
+        # update db with players already paired
+        players.load(*[user_id for pair in pairs for user_id in pair])
+        for user_id_1, user_id_2 in pairs:
+            players.push(user_id_1, {'opponents': user_id_2})
+            players.push(user_id_2, {'opponents': user_id_1})
+            # change users' state to play from ready
+            players.set(user_id_1, {'status': 'play'})
+            players.set(user_id_2, {'status': 'play'})
+        players.flush()
 
-            # update db with players already paired
-            db['players'].update_one(
-                {'id': player['id']},
-                {
-                    '$push': {
-                        'opponents': candidate['id']
-                    }
-                }
-            )
-            db['players'].update_one(
-                {'id': candidate['id']},
-                {
-                    '$push': {
-                        'opponents': player['id']
-                    }
-                }
-            )
-
-            pair_players(player['id'], candidate['id'])
+    try:
+        for user_id_1, user_id_2 in pairs:
+            pair_players(user_id_1, user_id_2, players)
+    finally:
+        players.flush()
 
 
-def pair_players(user_id_1, user_id_2):
+def pair_players(user_id_1, user_id_2, players):
     log('PROGRAM', '{} and {} are going to be paired.'.format(user_id_1, user_id_2))
 
-    # change users' state to play from ready
-    db['players'].update_many(
-        {'id': {'$in': [user_id_1, user_id_2]}},
-        {'$set': {'status': 'play'}}
-    )
-
     # send group im to the opponents
-    channel_id = send_mpim([user_id_1, user_id_2], MSG_ROUND_START)
+    channel_id = send_mpim([user_id_1, user_id_2], render('round_start', players.game_id))
 
     # save play channel for future checking
-    db['players'].update_many(
-        {'id': {'$in': [user_id_1, user_id_2]}},
-        {'$set': {'play_channel': channel_id}}
-    )
+    for user_id in (user_id_1, user_id_2):
+        players.set(user_id, {'play_channel': channel_id})
 
-    ask_question_from_players(user_id_1, user_id_2)
+    ask_question_from_players(user_id_1, user_id_2, players)
 
 
-def ask_question_from_players(user_id_1, user_id_2):
+def ask_question_from_players(user_id_1, user_id_2, players):
     player_id = None
     opponent_id = None
 
     # determine who's playing
-    if (db['players'].find_one({'id': user_id_1})['status'] == 'play' or
-       db['players'].find_one({'id': user_id_1})['status'] == 'answer'):
+    if players[user_id_1]['status'] in ('play', 'answer'):
         player_id = user_id_1
         opponent_id = user_id_2
-    elif (db['players'].find_one({'id': user_id_2})['status'] == 'play' or
-          db['players'].find_one({'id': user_id_1})['status'] == 'answer'):
+    elif players[user_id_2]['status'] in ('play', 'answer'):
         player_id = user_id_2
         opponent_id = user_id_1
     else:
         # end of round (we can't get here)
         pass
 
+    player_st = players[player_id]
+
     # if there wasn't any question asked from this player in this round
-    if (db['players'].find_one({'id': player_id})['current_question_num'] == 0):
+    if player_st['current_question_num'] == 0:
         send_mpim(
             [player_id, opponent_id],
-            MSG_ROUND_NEXT_USER.format(user_name=db['players'].find_one({'id': player_id})['name'])
+            render('round_next_user', players.game_id, user_name=user_directory.name(player_id))
         )
 
-        db['players'].update_one({'id': player_id}, {'$set': {'current_question_num': 1}})
+        players.set(player_id, {'current_question_num': 1})
 
     # set up shortcuts
-    current_question_num = db['players'].find_one({'id': player_id})['current_question_num']
-    question = db['players'].find_one({'id': opponent_id})['questions'][current_question_num - 1]
+    current_question_num = player_st['current_question_num']
+    question = players[opponent_id]['questions'][current_question_num - 1]
 
     # ask the question
     send_mpim(
         [player_id, opponent_id],
-        MSG_ROUND_QUESTION.format(
-            user_name=db['players'].find_one({'id': player_id})['name'],
+        render(
+            'round_question',
+            players.game_id,
+            user_name=user_directory.name(player_id),
             number=NUMBERS[current_question_num - 1],
             question=question
         )
     )
 
     # set status so we are waiting for this player's answer
-    db['players'].update_one({'id': player_id}, {'$set': {'status': 'answer'}})
+    players.set(player_id, {'status': 'answer'})
 
 
 # TODO: cancel
 # TODO: redoable setup
 # TODO: profile picture
-def handle_setup(user_id, message):
-    player_st = db['players'].find_one({'id': user_id})
+def handle_setup(user_id, intent, players):
+    message = intent.text
+    player_st = players[user_id]
+    question_count = len(player_st['questions'])
+    answer_count = len(player_st['answers'])
     # question
-    if len(player_st['questions']) == len(player_st['answers']):
+    players.expect(user_id, {
+        'status': 'setup',
+        'questions': {'$size': question_count},
+        'answers': {'$size': answer_count}
+    })
+    if question_count == answer_count:
         send_im(
             user_id,
-            MSG_QUESTION_DONE.format(
-                number=NUMBERS[len(player_st['questions'])],
+            render(
+                'question_done',
+                players.game_id,
+                number=NUMBERS[question_count],
                 question=message
             )
         )
-        db['players'].update_one({'id': user_id}, {'$push': {'questions': message}})
-        send_im(user_id, MSG_ANSWER.format(number=NUMBERS[len(player_st['answers'])]))
+        players.push(user_id, {'questions': message})
+        send_im(user_id, render('answer', players.game_id, number=NUMBERS[answer_count]))
     # answer
     else:
-        answer = None
-        if 'true' in message.lower():
-            answer = True
-        elif 'false' in message.lower():
-            answer = False
-        else:
-            send_im(user_id, MSG_ANSWER_REPEAT.format(number=NUMBERS[len(player_st['answers'])]))
+        answer = intent.answer
+        if answer is None:
+            send_im(user_id, render('answer_repeat', players.game_id, number=NUMBERS[answer_count]))
 
         if answer is not None:
             send_im(
                 user_id,
-                MSG_ANSWER_DONE.format(
-                    number=NUMBERS[len(player_st['answers'])],
+                render(
+                    'answer_done',
+                    players.game_id,
+                    number=NUMBERS[answer_count],
                     answer=answer
                 )
             )
-            db['players'].update_one({'id': user_id}, {'$push': {'answers': answer}})
+            players.push(user_id, {'answers': answer})
 
             # if we're done with the setup
-            if len(player_st['questions']) == 3:
-                send_im(user_id, MSG_SETUP_DONE)
-                db['players'].update_one({'id': user_id}, {'$set': {'status': 'ready'}})
-                select_for_pairing()
+            if question_count == 3:
+                send_im(user_id, render('setup_done', players.game_id))
+                players.set(user_id, {'status': 'ready'})
+                # pairing reads the players collection, so it has to see this player as ready
+                if not players.flush():
+                    return
+                select_for_pairing(players.game_id)
             else:
-                send_im(user_id, MSG_QUESTION.format(number=NUMBERS[len(player_st['questions'])]))
+                send_im(user_id, render('question', players.game_id, number=NUMBERS[question_count]))
 
 
-def handle_answer(user_id, message):
-    player_st = db['players'].find_one({'id': user_id})
-    opponent_st = db['players'].find_one({'id': player_st['opponents'][-1]})
+def handle_answer(user_id, intent, players):
+    player_st = players[user_id]
+    opponent_st = players[player_st['opponents'][-1]]
     current_question_num = player_st['current_question_num']
 
-    answer = None
-    if 'true' in message.lower():
-        answer = True
-    elif 'false' in message.lower():
-        answer = False
-    else:
-        send_mpim([user_id, opponent_st['id']], MSG_ROUND_ANSWER_REPEAT.format(user_name=player_st['name']))
+    players.expect(user_id, {'status': 'answer', 'current_question_num': current_question_num})
+    answer = intent.answer
+    if answer is None:
+        send_mpim(
+            [user_id, opponent_st['id']],
+            render('round_answer_repeat', players.game_id, user_name=player_st['name'])
+        )
 
     if answer is not None:
         # handle correctness
         if answer == opponent_st['answers'][current_question_num - 1]:
-            send_mpim([user_id, opponent_st['id']], MSG_ROUND_ANSWER_CORRECT.format(user_name=player_st['name']))
-            db['players'].update_one({'id': user_id}, {'$inc': {'points': 1}})
+            send_mpim(
+                [user_id, opponent_st['id']],
+                render('round_answer_correct', players.game_id, user_name=player_st['name'])
+            )
+            players.inc(user_id, {'points': 1})
+            players.after_flush(partial(leaderboard.add_points, players.game_id, user_id, 1))
         else:
-            send_mpim([user_id, opponent_st['id']], MSG_ROUND_ANSWER_INCORRECT.format(user_name=player_st['name']))
+            send_mpim(
+                [user_id, opponent_st['id']],
+                render('round_answer_incorrect', players.game_id, user_name=player_st['name'])
+            )
 
         # update current question number (or state if we're done)
         if current_question_num == 3:
-            db['players'].update_one({'id': user_id}, {'$set': {'current_question_num': 0}})
             # TODO: could be something else as now we're sending the no game ongoing message to the first user
             #  while the second user still answering the questions
-            db['players'].update_one({'id': user_id}, {'$set': {'status': 'ready'}})
+            players.set(user_id, {'current_question_num': 0, 'status': 'ready'})
         else:
-            db['players'].update_one({'id': user_id}, {'$inc': {'current_question_num': 1}})
-
-        # reset shortcuts, because it could changed
-        player_st = db['players'].find_one({'id': user_id})
-        opponent_st = db['players'].find_one({'id': player_st['opponents'][-1]})
+            players.inc(user_id, {'current_question_num': 1})
 
         if player_st['status'] == 'ready' and opponent_st['status'] == 'ready':
             # end of round
-            db['players'].update_many(
-                {'id': {'$in': [user_id, opponent_st['id']]}},
-                {
-                    '$set': {
+            for player_id in (user_id, opponent_st['id']):
+                players.set(
+                    player_id,
+                    {
                         # should be datetime object, because date cannot be encoded as BSON
                         'last_round': datetime.today().replace(hour=0, minute=0, second=0, microsecond=0),
                         'play_channel': None
-                    },
-                    '$inc': {
-                        'rounds': 1
                     }
-                }
-            )
+                )
+                players.inc(player_id, {'rounds': 1})
 
-            send_mpim([player_st['id'], opponent_st['id']], MSG_ROUND_END)
-            send_im(player_st['id'], MSG_ROUND_POINTS.format(points=player_st['points']))
-            send_im(opponent_st['id'], MSG_ROUND_POINTS.format(points=opponent_st['points']))
+            send_mpim([player_st['id'], opponent_st['id']], render('round_end', players.game_id))
+            send_im(player_st['id'], render('round_points', players.game_id, points=player_st['points']))
+            send_im(opponent_st['id'], render('round_points', players.game_id, points=opponent_st['points']))
         else:
             # ask next question
-            ask_question_from_players(user_id, opponent_st['id'])
+            ask_question_from_players(user_id, opponent_st['id'], players)
 
 
-def main():
-    # 0.1 second delay between reading from firehose
-    READ_WEBSOCKET_DELAY = 0.1
+async def run_stats_log(runner):
+    while True:
+        await asyncio.sleep(STATS_LOG_DELAY)
+        log('STATS', 'Event handling: {}'.format(runner.stats()))
+        log('STATS', 'Deduplication: {}'.format(deduplicator.stats()))
+        log('STATS', 'Latencies: {}'.format(metrics.summary()))
 
-    daily_done = False
-    if db['settings'].find_one({'name': 'status'}) is None:
-        db['settings'].update_one({'name': 'status'}, {'$set': {'value': 'wait'}}, upsert=True)
 
-    if slack_client.rtm_connect():
-        log('PROGRAM', 'QuestionBot connected and running!')
+async def keep_leadership(leader, executor):
+    # the renewal has a thread of its own, a long job or a slow handler must not let the lease expire
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(leader.ttl / 3)
+        if not await loop.run_in_executor(executor, leader.acquire):
+            raise RuntimeError('Leader lease lost.')
+
+
+def lead(leader, queue, broadcast):
+    if not slack_client.rtm_connect():
+        log('PROGRAM', 'Connection failed. Invalid Slack token or bot ID?')
+        return
+
+    channel_registry.load(slack_client.server.login_data)
+    conversations.load_ims(slack_client.server.login_data)
+    # rtm.start can take longer than the renewal period
+    if not leader.acquire():
+        return
+    log('CLUSTER', '{} is the leader, QuestionBot connected and running!'.format(WORKER_ID))
+
+    def enqueue(events):
+        # another worker could be the leader already, its events must not be queued twice
+        if not leader.held():
+            log('CLUSTER', 'Leader lease of {} lost.'.format(WORKER_ID))
+            runner.stop()
+            return
+        # the caches of every worker follow the directory events, a single partition owner isn't enough
+        broadcast.put([event for event in events if is_directory_event(event)])
+        queue.put([event for event in events if not is_directory_event(event)])
+
+    lease_executor = ThreadPoolExecutor(max_workers=1)
+    runner = RTMRunner(slack_client, [enqueue], log=log)
+    try:
+        asyncio.run(runner.run(scheduler.run, run_stats_log, lambda runner: keep_leadership(leader, lease_executor)))
+    finally:
+        slack_client.server.websocket.close()
+        lease_executor.shutdown(wait=False)
+
+
+def run_cluster():
+    """
+        Runs one of several workers sharing the load.
+
+        The worker holding the leader lease keeps the RTM connection, runs the daily jobs and puts the events on a
+        work queue in Mongo. Every worker, the leader included, handles the events of the queue partitions it holds.
+        The user and channel events are broadcast instead, so every worker updates its caches from them.
+    """
+    games.shared = True
+    leaderboard.shared = True
+
+    queue = WorkQueue(db['events'], CLUSTER_PARTITIONS)
+    broadcast = Broadcast(db['broadcasts'])
+    worker = ClusterWorker(db, WORKER_ID, queue, parse_slack_output, broadcast, observe_directory, log=log)
+    threading.Thread(target=worker.run, daemon=True).start()
+
+    leader = Lease(db['leases'], 'leader', WORKER_ID)
+    try:
         while True:
-            parse_slack_output(slack_client.rtm_read())
+            if leader.acquire():
+                try:
+                    lead(leader, queue, broadcast)
+                except Exception as e:
+                    log('CLUSTER', 'Leadership of {} ended: {}'.format(WORKER_ID, e))
+                finally:
+                    leader.release()
+            time.sleep(LEADER_RETRY_DELAY)
+    finally:
+        worker.stop()
+
+
+@contextmanager
+def pairing_mutex(game_id):
+    # events are handled concurrently, but the same players must not be paired twice
+    with pairing_lock:
+        if not games.shared:
+            yield
+            return
+
+        # other workers could pair the same game as well
+        lease = Lease(db['leases'], 'pairing:' + game_id, WORKER_ID)
+        while not lease.acquire():
+            time.sleep(PAIRING_RETRY_DELAY)
+        try:
+            yield
+        finally:
+            lease.release()
 
-            # handle daily jobs
-            if datetime.now().hour == DAILY_START_HOURS and not daily_done:
-                daily_done = True
-                log('PROGRAM', 'Running daily script.')
-                do_daily()
-            elif datetime.now().hour == 0:
-                daily_done = False
 
-            time.sleep(READ_WEBSOCKET_DELAY)
+def main():
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT))
+        log('PROGRAM', 'Serving metrics on http://127.0.0.1:{}/metrics'.format(METRICS_PORT))
+    setup(application.slack_client, application.db)
+
+    def prepare_database():
+        # the first query waits for the server selection
+        migrate(db)
+        ensure_indexes(db)
+        for collection, query, sort in collection_scans(db):
+            log('DB', 'Query on {} scans the whole collection: {} sorted by {}'.format(collection, query, sort))
+        games.load()
+        templates.load()
+
+    # rtm.start takes seconds on a big workspace, the caches are filled in the meantime
+    warm_up = [('database', prepare_database), ('users', user_directory.refresh), ('conversations', conversations.load)]
+    if CLUSTER_PARTITIONS > 0:
+        application.start(None, *warm_up)
+        run_cluster()
+    elif application.start(slack_client.rtm_connect, *warm_up):
+        channel_registry.load(slack_client.server.login_data)
+        conversations.load_ims(slack_client.server.login_data)
+        log('PROGRAM', 'QuestionBot connected and running!')
+        runner = RTMRunner(slack_client, [parse_slack_output], concurrency=HANDLER_CONCURRENCY, log=log)
+        asyncio.run(runner.run(scheduler.run, run_stats_log))
     else:
         log('PROGRAM', 'Connection failed. Invalid Slack token or bot ID?')
 
 
-# globals
-slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
-mongodb_uri = os.environ.get('MONGODB_URI')
-try:
-    conn = pymongo.MongoClient(mongodb_uri)
-    log('DB', 'Connection successful.')
-except pymongo.errors.ConnectionFailure as e:
-    log('DB', 'Could not connect to MongoDB: %s' % e)
-
-db = conn[urlparse(mongodb_uri).path[1:]]
+def setup(client, database):
+    '''
+        Creates the services of the bot on a Slack client and a database, the load test passes fakes of both.
 
+            :param client: the Slack client
+            :type client: slackclient.SlackClient
+            :param database: the database
+            :type database: pymongo.database.Database
+    '''
+    global slack_client, web_client, channel_registry, user_directory, db, games, leaderboard, conversations, \
+        slack_sender, outbox, scheduler, deduplicator, templates
+
+    slack_client = client
+    # every Web API call goes through the requester
+    slack_client.server.api_requester.do = metrics.instrument_requester(slack_client.server.api_requester.do)
+    web_client = WebClient(slack_client, limiter=RateLimiter(), metrics=metrics)
+    channel_registry = ChannelRegistry(web_client.api_call)
+    user_directory = UserDirectory(web_client.api_call)
+
+    db = database
+    games = GameRegistry(db)
+    leaderboard = Leaderboard(db['players'])
+    conversations = ConversationCache(db['conversations'])
+    deduplicator = Deduplicator(db['handled_events'])
+    templates = Templates(db['templates'], TEMPLATES, language_of=game_language, log=log)
+    slack_sender = SlackSender(web_client, conversations)
+    outbox = Outbox(slack_sender, on_post=on_post)
+    scheduler = Scheduler(db['schedule'], scheduled_jobs, max_sleep=SCHEDULE_REFRESH_DELAY, log=log)
+
+
+# globals, the clients are created on first use and the services by setup()
+metrics = Metrics()
+application = Application(
+    partial(create_slack_client, pool_size=max(HANDLER_CONCURRENCY, 8) * 2),
+    partial(create_database, event_listeners=[metrics.command_listener()]),
+    log=log
+)
+slack_client = web_client = channel_registry = user_directory = db = games = leaderboard = conversations = None
+slack_sender = outbox = scheduler = deduplicator = templates = None
+pairing_lock = threading.Lock()
+WORKER_ID = '{}:{}'.format(socket.gethostname(), os.getpid())
 
 if __name__ == "__main__":
     main()
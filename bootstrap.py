@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import pymongo
+from slackclient import SlackClient
+
+from webapi import PooledRequester
+
+
+def create_slack_client(token=None, pool_size=16):
+    '''
+        Creates the Slack client of the bot, with pooled Web API connections.
+
+            :param token: the bot token, SLACK_BOT_TOKEN if None
+            :type token: str
+    '''
+    slack_client = SlackClient(token or os.environ.get('SLACK_BOT_TOKEN'))
+    slack_client.server.api_requester = PooledRequester(pool_size=pool_size)
+    return slack_client
+
+
+def create_database(uri=None, **kwargs):
+    '''
+        Creates the database of the bot. The client connects in the background, the first query waits for it.
+
+            :param uri: the MongoDB URI with the database name, MONGODB_URI if None
+            :type uri: str
+            :param kwargs: options of pymongo.MongoClient
+            :rtype: pymongo.database.Database
+    '''
+    uri = uri or os.environ.get('MONGODB_URI')
+    if not uri:
+        raise ValueError('MONGODB_URI is not set!')
+    name = urlparse(uri).path[1:]
+    if not name:
+        raise ValueError('MONGODB_URI has no database name!', uri)
+    return pymongo.MongoClient(uri, **kwargs)[name]
+
+
+class Lazy:
+    '''
+        Value created by a factory on first use, once even when several threads ask for it at the same time.
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._created = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._created:
+            with self._lock:
+                if not self._created:
+                    self._value = self.factory()
+                    self._created = True
+        return self._value
+
+
+class Application:
+    '''
+        Startup of the bot.
+
+        The clients are created on first use, so importing the bot doesn't connect anywhere. start() runs the RTM
+        connection next to the warm-up of the database and the caches instead of one after the other, and the
+        time from the start of the process to the first reply is reported once.
+
+            :param slack_client_factory: creates the Slack client
+            :type slack_client_factory: callable
+            :param database_factory: creates the database
+            :type database_factory: callable
+    '''
+
+    def __init__(self, slack_client_factory, database_factory, log=print):
+        self.started = time.monotonic()
+        self.log = log
+        self.first_reply = None
+        self._slack_client = Lazy(slack_client_factory)
+        self._db = Lazy(database_factory)
+
+    @property
+    def slack_client(self):
+        return self._slack_client.get()
+
+    @property
+    def db(self):
+        return self._db.get()
+
+    def start(self, connect, *tasks):
+        '''
+            Runs connect and the warm-up tasks in parallel and waits for all of them.
+
+                :param connect: connects to the RTM API, returns False when it failed, None to skip it
+                :type connect: callable
+                :param tasks: (name, callable) pairs
+                :return: the result of connect
+                :raises Exception: the first error of a warm-up task
+        '''
+        steps = ([('rtm_connect', connect)] if connect is not None else []) + list(tasks)
+        with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            futures = [executor.submit(self._timed, name, step) for name, step in steps]
+            results = [future.result() for future in futures]
+        self.log('PROGRAM', 'Started in {:.2f} s.'.format(time.monotonic() - self.started))
+        return results[0] if connect is not None else None
+
+    def replied(self):
+        if self.first_reply is None:
+            self.first_reply = time.monotonic() - self.started
+            self.log('PROGRAM', 'First reply {:.2f} s after start.'.format(self.first_reply))
+
+    def _timed(self, name, step):
+        started = time.monotonic()
+        result = step()
+        self.log('PROGRAM', 'Startup step {} took {:.2f} s.'.format(name, time.monotonic() - started))
+        return result
@@ -0,0 +1,274 @@
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+
+class Lease:
+    '''
+        Time limited, renewable ownership of a name, stored in Mongo.
+
+        Only one owner can hold a lease at a time, another owner can take it over when it wasn't renewed within ttl
+        seconds. held() is pessimistic: it turns false a renewal period before the lease could expire.
+
+            :param collection: the leases collection, needs a unique index on name
+            :type collection: pymongo.collection.Collection
+            :param name: the name of the lease
+            :type name: str
+            :param owner: the id of the worker
+            :type owner: str
+            :param ttl: seconds the lease is valid without renewal
+            :type ttl: float
+    '''
+
+    def __init__(self, collection, name, owner, ttl=30):
+        self.collection = collection
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self._valid_until = 0.0
+
+    def acquire(self):
+        '''
+            Acquires or renews the lease.
+
+                :return: whether the lease is held
+                :rtype: bool
+        '''
+        started = time.monotonic()
+        now = datetime.utcnow()
+        try:
+            self.collection.update_one(
+                {'name': self.name, '$or': [{'owner': self.owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': self.owner, 'expires': now + timedelta(seconds=self.ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # somebody else holds it
+            self._valid_until = 0.0
+            return False
+        self._valid_until = started + self.ttl * 2 / 3
+        return True
+
+    def held(self):
+        return time.monotonic() < self._valid_until
+
+    def release(self):
+        self._valid_until = 0.0
+        self.collection.delete_one({'name': self.name, 'owner': self.owner})
+
+
+class WorkQueue:
+    '''
+        Event queue in Mongo, partitioned by user id.
+
+        The events of one partition are handed out one at a time in insertion order, so a single consumer per
+        partition handles them strictly in order.
+
+            :param collection: the queued events
+            :type collection: pymongo.collection.Collection
+            :param partitions: the number of partitions
+            :type partitions: int
+    '''
+
+    def __init__(self, collection, partitions):
+        self.collection = collection
+        self.partitions = partitions
+
+    def partition(self, event):
+        key = event.get('user') or event.get('channel') or ''
+        if isinstance(key, dict):
+            key = key.get('id', '')
+        # crc32 is the same in every process, unlike hash()
+        return zlib.crc32(key.encode('utf-8')) % self.partitions
+
+    def put(self, events):
+        if events:
+            self.collection.insert_many(
+                [{'partition': self.partition(event), 'owner': None, 'event': event} for event in events]
+            )
+
+    def pending_partitions(self):
+        return set(self.collection.distinct('partition', {'owner': None}))
+
+    def take(self, partition, owner):
+        return self.collection.find_one_and_update(
+            {'partition': partition, 'owner': None},
+            {'$set': {'owner': owner}},
+            sort=[('_id', ASCENDING)]
+        )
+
+    def done(self, item):
+        self.collection.delete_one({'_id': item['_id']})
+
+    def abandon(self, partition, owner):
+        '''
+            Drops the events a previous owner of the partition took but never finished.
+
+            They might have been handled partially already, so handling them again could send the same messages
+            twice. Events are delivered at most once.
+
+                :return: the number of dropped events
+                :rtype: int
+        '''
+        return self.collection.delete_many({'partition': partition, 'owner': {'$nin': [None, owner]}}).deleted_count
+
+
+class Broadcast:
+    '''
+        Events every worker applies, like the profile and channel changes kept in the caches of each process.
+
+        The events are stored in Mongo in insertion order and every worker reads the ones it hasn't read yet.
+        They expire with the TTL index of the collection (see schema.py).
+
+            :param collection: the broadcast events
+            :type collection: pymongo.collection.Collection
+    '''
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._last_id = None
+
+    def put(self, events):
+        if events:
+            self.collection.insert_many([{'created': datetime.utcnow(), 'event': event} for event in events])
+
+    def start(self):
+        '''
+            Skips the events stored so far, the caches of a starting worker are loaded fresh.
+        '''
+        last = self.collection.find_one({}, {'_id': True}, sort=[('_id', DESCENDING)])
+        self._last_id = last['_id'] if last is not None else None
+
+    def read(self):
+        '''
+            Returns the events stored since the last read.
+
+                :rtype: list
+        '''
+        query = {} if self._last_id is None else {'_id': {'$gt': self._last_id}}
+        items = list(self.collection.find(query).sort('_id', ASCENDING))
+        if items:
+            self._last_id = items[-1]['_id']
+        return [item['event'] for item in items]
+
+
+class ClusterWorker:
+    '''
+        Consumes the work queue together with the other workers.
+
+        Every worker announces itself with a heartbeat lease and holds leases for its fair share of the partitions.
+        Each held partition is drained by one thread at a time, so the events of a user are never handled twice or
+        out of order, while different partitions are handled in parallel.
+
+            :param db: the database
+            :type db: pymongo.database.Database
+            :param worker_id: the unique id of this worker
+            :type worker_id: str
+            :param queue: the work queue
+            :type queue: WorkQueue
+            :param handle: callable receiving a list of events
+            :type handle: callable
+            :param broadcast: the events every worker applies, optional
+            :type broadcast: Broadcast
+            :param observe: callable receiving a broadcast event
+            :type observe: callable
+    '''
+
+    def __init__(self, db, worker_id, queue, handle, broadcast=None, observe=None, lease_ttl=30, poll_delay=0.2,
+                 log=print):
+        self.db = db
+        self.worker_id = worker_id
+        self.queue = queue
+        self.handle = handle
+        self.broadcast = broadcast
+        self.observe = observe
+        self.lease_ttl = lease_ttl
+        self.poll_delay = poll_delay
+        self.log = log
+        self.heartbeat = Lease(db['leases'], 'worker:' + worker_id, worker_id, lease_ttl)
+        self.partitions = {}
+        self.executor = ThreadPoolExecutor(max_workers=min(queue.partitions, 16))
+        self._draining = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def live_workers(self):
+        return max(1, len(self.db['leases'].distinct('name', {
+            'name': {'$regex': '^worker:'},
+            'expires': {'$gt': datetime.utcnow()}
+        })))
+
+    def rebalance(self):
+        self.heartbeat.acquire()
+        share = -(-self.queue.partitions // self.live_workers())
+
+        # renew the held partitions, give up the ones over the fair share
+        for partition, lease in list(self.partitions.items()):
+            if len(self.partitions) > share and partition not in self._draining:
+                lease.release()
+                del self.partitions[partition]
+            elif not lease.acquire():
+                del self.partitions[partition]
+
+        for partition in range(self.queue.partitions):
+            if len(self.partitions) >= share:
+                break
+            if partition not in self.partitions:
+                lease = Lease(self.db['leases'], 'partition:{}'.format(partition), self.worker_id, self.lease_ttl)
+                if lease.acquire():
+                    dropped = self.queue.abandon(partition, self.worker_id)
+                    if dropped:
+                        self.log('CLUSTER', 'Dropped {} unfinished events of partition {}.'.format(dropped, partition))
+                    self.partitions[partition] = lease
+
+    def run(self):
+        last_rebalance = 0.0
+        if self.broadcast is not None:
+            self.broadcast.start()
+        while not self._stopped.is_set():
+            if time.monotonic() - last_rebalance > self.lease_ttl / 3:
+                self.rebalance()
+                last_rebalance = time.monotonic()
+            if self.broadcast is not None:
+                self._apply_broadcast()
+            for partition in self.queue.pending_partitions() & set(self.partitions):
+                with self._lock:
+                    if partition in self._draining:
+                        continue
+                    self._draining.add(partition)
+                self.executor.submit(self._drain, partition)
+            self._stopped.wait(self.poll_delay)
+
+    def stop(self):
+        self._stopped.set()
+        self.executor.shutdown(wait=True)
+        for lease in self.partitions.values():
+            lease.release()
+        self.heartbeat.release()
+
+    def _apply_broadcast(self):
+        for event in self.broadcast.read():
+            try:
+                self.observe(event)
+            except Exception as e:
+                self.log('CLUSTER', 'Broadcast event failed: {}'.format(e))
+
+    def _drain(self, partition):
+        try:
+            while partition in self.partitions and self.partitions[partition].held():
+                item = self.queue.take(partition, self.worker_id)
+                if item is None:
+                    break
+                try:
+                    self.handle([item['event']])
+                except Exception as e:
+                    self.log('CLUSTER', 'Event handling failed: {}'.format(e))
+                self.queue.done(item)
+        finally:
+            with self._lock:
+                self._draining.discard(partition)
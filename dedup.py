@@ -0,0 +1,83 @@
+import threading
+from datetime import datetime, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+from directory import TTLCache
+
+
+class Deduplicator:
+    '''
+        Lets only the first delivery of an event through.
+
+        Slack can deliver a message again after an RTM reconnect and a work queue can hand an event out twice, so
+        an event is identified by its channel and ts. The recently seen keys are kept in a bounded LRU, the
+        first delivery is decided by inserting the key into Mongo, so it holds across restarts and workers. The
+        keys expire from Mongo with the TTL index of the collection (see schema.py).
+
+            :param collection: the keys of the handled events
+            :type collection: pymongo.collection.Collection
+            :param size: the number of keys kept in memory
+            :type size: int
+            :param ttl: seconds a key is kept in memory
+            :type ttl: float
+    '''
+
+    def __init__(self, collection, size=10000, ttl=24 * 60 * 60):
+        self.collection = collection
+        self.claimed = 0
+        self.duplicates = 0
+        self._seen = TTLCache(size, ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(event):
+        '''
+            Returns the key of an event, None if it can't be identified.
+        '''
+        if not event.get('ts') or not event.get('channel'):
+            return None
+        return '{}:{}'.format(event['channel'], event['ts'])
+
+    def claim(self, event):
+        '''
+            Marks an event as handled.
+
+                :return: False if the event was claimed before
+                :rtype: bool
+        '''
+        key = self.key(event)
+        if key is None:
+            return True
+
+        if self._seen.get(key) is not None:
+            with self._lock:
+                self.duplicates += 1
+            return False
+
+        try:
+            self.collection.insert_one({'_id': key, 'seen_at': datetime.now(timezone.utc)})
+            first = True
+        except DuplicateKeyError:
+            first = False
+
+        self._seen.set(key, True)
+        with self._lock:
+            if first:
+                self.claimed += 1
+            else:
+                self.duplicates += 1
+        return first
+
+    def release(self, event):
+        '''
+            Forgets an event whose handling failed, so it is handled when it is delivered again.
+        '''
+        key = self.key(event)
+        if key is None:
+            return
+        self._seen.pop(key)
+        self.collection.delete_one({'_id': key})
+
+    def stats(self):
+        return {'claimed': self.claimed, 'duplicates': self.duplicates, 'size': len(self._seen)}
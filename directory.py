@@ -0,0 +1,310 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def paginate(api_call, method, key, limit=200, **kwargs):
+    '''
+        Streams the items of a cursor-paginated Web API list method, one page is kept in memory at a time.
+
+            :param api_call: raw Slack Web API call returning the response dict
+            :type api_call: callable
+            :param method: the list method, e.g. users.list
+            :type method: str
+            :param key: the key of the items in the response, e.g. members
+            :type key: str
+            :param limit: the number of items per page
+            :type limit: int
+    '''
+    cursor = None
+    while True:
+        if cursor:
+            kwargs['cursor'] = cursor
+        api_call_response = api_call(method, limit=limit, **kwargs)
+        if not api_call_response.get('ok'):
+            raise ValueError('Connection error!', api_call_response.get('error'), api_call_response.get('args'))
+        yield from api_call_response.get(key) or []
+        cursor = (api_call_response.get('response_metadata') or {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+class TTLCache:
+    '''
+        Bounded mapping with least-recently-used eviction where every entry expires after a fixed time.
+
+            :param max_size: the maximum number of entries kept
+            :type max_size: int
+            :param ttl: seconds an entry stays valid
+            :type ttl: float
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def values(self):
+        now = time.monotonic()
+        with self._lock:
+            return [value for value, expires in self._entries.values() if expires > now]
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class ChannelRegistry:
+    '''
+        Resolves channel types without calling the Web API for every message.
+
+        The type comes from the channel id prefix where it is unambiguous (D: dm, C: pub), otherwise from the
+        channel metadata of rtm.start and the channel events of the RTM stream. Only a cache miss on a private
+        channel id reaches groups.info.
+
+        The same sources fill a channel name index, so resolving a #channel mention only pages through
+        channels.list and groups.list for a channel the registry hasn't seen yet.
+
+            :param api_call: raw Slack Web API call returning the response dict
+            :type api_call: callable
+    '''
+
+    # the RTM events observe() applies
+    EVENTS = (
+        'channel_created', 'channel_joined', 'group_joined', 'channel_rename', 'group_rename', 'mpim_joined',
+        'mpim_open', 'im_created', 'channel_deleted', 'group_archive', 'group_left'
+    )
+
+    def __init__(self, api_call, max_size=4096, ttl=6 * 60 * 60):
+        self.api_call = api_call
+        self.cache = TTLCache(max_size, ttl)
+        self.names = TTLCache(max_size, ttl)
+        self.prefix_hits = 0
+
+    def load(self, login_data):
+        '''
+            Fills the registry from the rtm.start response.
+
+                :param login_data: the rtm.start response
+                :type login_data: dict
+        '''
+        if not login_data:
+            return
+        for channel in login_data.get('channels', []):
+            self.cache.set(channel['id'], 'pub')
+            self._name(channel)
+        for group in login_data.get('groups', []):
+            self.cache.set(group['id'], 'gdm' if group.get('is_mpim') else 'priv')
+            self._name(group)
+        for mpim in login_data.get('mpims', []):
+            self.cache.set(mpim['id'], 'gdm')
+        for im in login_data.get('ims', []):
+            self.cache.set(im['id'], 'dm')
+
+    def observe(self, event):
+        '''
+            Keeps the registry current from RTM channel events.
+
+                :param event: an RTM event
+                :type event: dict
+        '''
+        event_type = event.get('type')
+        channel = event.get('channel')
+        if event_type in ('channel_created', 'channel_joined') and isinstance(channel, dict):
+            self.cache.set(channel['id'], 'pub')
+            self._name(channel)
+        elif event_type == 'group_joined' and isinstance(channel, dict):
+            self.cache.set(channel['id'], 'gdm' if channel.get('is_mpim') else 'priv')
+            self._name(channel)
+        elif event_type in ('channel_rename', 'group_rename') and isinstance(channel, dict):
+            self._name(channel)
+        elif event_type in ('mpim_joined', 'mpim_open') and isinstance(channel, dict):
+            self.cache.set(channel['id'], 'gdm')
+        elif event_type == 'im_created' and isinstance(channel, dict):
+            self.cache.set(channel['id'], 'dm')
+        elif event_type in ('channel_deleted', 'group_archive', 'group_left') and isinstance(channel, str):
+            self.cache.pop(channel)
+
+    def get_type(self, channel_id):
+        '''
+            Determines the channel type based on channel id.
+
+                :param channel_id: the id of the channel
+                :type channel_id: str
+                :return: returns the type of the channel
+                    pub: public channel (channel)
+                    priv: private channel (group)
+                    dm: direct message channel (im)
+                    gdm: group dm message channel (mpim)
+                :rtype: str
+        '''
+        if channel_id.startswith('D'):
+            self.prefix_hits += 1
+            return 'dm'
+        if channel_id.startswith('C'):
+            self.prefix_hits += 1
+            return 'pub'
+
+        channel_type = self.cache.get(channel_id)
+        if channel_type is None:
+            channel_type = self._fetch_type(channel_id)
+            self.cache.set(channel_id, channel_type)
+        return channel_type
+
+    def get_id(self, channel_name):
+        '''
+            Returns the id of a public or private channel by its name, None if there isn't such channel.
+
+                :param channel_name: the name of the channel without #
+                :type channel_name: str
+                :rtype: str
+        '''
+        channel_id = self.names.get(channel_name)
+        if channel_id is not None:
+            return channel_id
+
+        # index every page on the way, stop at the first match
+        for method, key, channel_type in (('channels.list', 'channels', 'pub'), ('groups.list', 'groups', 'priv')):
+            for channel in paginate(self.api_call, method, key, exclude_members=True, exclude_archived=True):
+                self._name(channel)
+                if channel_type == 'pub' or not channel.get('is_mpim'):
+                    self.cache.set(channel['id'], channel_type)
+                if channel.get('name') == channel_name and not channel.get('is_mpim'):
+                    return channel['id']
+        return None
+
+    def _name(self, channel):
+        if channel.get('name') and not channel.get('is_mpim'):
+            self.names.set(channel['name'], channel['id'])
+
+    def _fetch_type(self, channel_id):
+        group = self.api_call('groups.info', channel=channel_id)
+        if group.get('ok'):
+            return 'gdm' if group.get('group').get('is_mpim') else 'priv'
+
+        # unknown prefix, fall back to asking both endpoints
+        channel = self.api_call('channels.info', channel=channel_id)
+        if channel.get('ok'):
+            return 'pub'
+        elif channel.get('error') == 'channel_not_found' and group.get('error') == 'channel_not_found':
+            return 'dm'
+        else:
+            raise ValueError('Connection error!', channel.get('error'), group.get('error'))
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['prefix_hits'] = self.prefix_hits
+        return stats
+
+
+class UserDirectory:
+    '''
+        In-process copy of the workspace user profiles.
+
+        Filled from users.list by refresh() and kept current from user_change and team_join RTM events, so admin
+        checks and name lookups don't need a users.info call per message. When the workspace has more users than
+        max_size the directory only keeps the recently used profiles and users() streams users.list page by page.
+
+            :param api_call: raw Slack Web API call returning the response dict
+            :type api_call: callable
+    '''
+
+    # the RTM events observe() applies
+    EVENTS = ('user_change', 'team_join')
+
+    def __init__(self, api_call, max_size=20000, ttl=24 * 60 * 60):
+        self.api_call = api_call
+        self.cache = TTLCache(max_size, ttl)
+        self.complete = False
+        self.loaded_at = None
+
+    def refresh(self):
+        '''
+            Reloads every profile from users.list.
+        '''
+        self.cache.clear()
+        count = 0
+        for user in self._list_users():
+            self.cache.set(user['id'], user)
+            count += 1
+        self.complete = count <= self.cache.max_size
+        self.loaded_at = time.monotonic()
+
+    def observe(self, event):
+        '''
+            Keeps the directory current from RTM user events.
+
+                :param event: an RTM event
+                :type event: dict
+        '''
+        if event.get('type') in ('user_change', 'team_join') and isinstance(event.get('user'), dict):
+            self.cache.set(event['user']['id'], event['user'])
+
+    def get(self, user_id):
+        user = self.cache.get(user_id)
+        if user is None:
+            api_call = self.api_call('users.info', user=user_id)
+            if not api_call.get('ok'):
+                raise ValueError('Connection error!', api_call.get('error'), api_call.get('args'))
+            user = api_call.get('user')
+            self.cache.set(user_id, user)
+        return user
+
+    def is_admin(self, user_id):
+        return self.get(user_id).get('is_admin') is True
+
+    def name(self, user_id):
+        return self.get(user_id).get('name')
+
+    def users(self):
+        '''
+            Returns every user profile, reloading them when the directory is outdated.
+
+                :return: the cached profiles, or a stream of users.list when they don't fit into the directory
+                :rtype: iterable
+        '''
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.cache.ttl:
+            self.refresh()
+        if not self.complete:
+            return self._list_users()
+        return self.cache.values()
+
+    def _list_users(self):
+        return paginate(self.api_call, 'users.list', 'members')
+
+    def stats(self):
+        return self.cache.stats()
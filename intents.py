@@ -0,0 +1,200 @@
+import re
+import string
+import time
+
+
+START_WORDS = frozenset(['start'])
+STOP_WORDS = frozenset(['stop'])
+RANK_WORDS = frozenset(['rank'])
+YES_WORDS = frozenset(['yes', 'y', 'yep', 'yeah', 'sure', 'ok', 'okay'])
+NO_WORDS = frozenset(['no', 'n', 'nope', 'cancel'])
+TRUE_WORDS = frozenset(['true'])
+FALSE_WORDS = frozenset(['false'])
+NEGATION_WORDS = frozenset(['not', 'never'])
+NEGATION_SUFFIXES = frozenset(["n't", 'n’t'])
+# a negation turns the yes/no or truth word at most this many words later
+NEGATION_SCOPE = 2
+
+# the kind of every known word, so a word costs one lookup
+WORDS = {}
+for _kind, _words in (('start', START_WORDS), ('stop', STOP_WORDS), ('rank', RANK_WORDS), ('yes', YES_WORDS),
+                      ('no', NO_WORDS), ('true', TRUE_WORDS), ('false', FALSE_WORDS)):
+    WORDS.update(dict.fromkeys(_words, _kind))
+del _kind, _words
+
+# the first channel mention or #channel name of the lower-cased text, only searched for if there is a #
+MENTION = re.compile(r"<#(\w+)(?:\|([\w-]*))?>|#([\w-]+)")
+# stripped from the ends of the words, apostrophes inside words (isn't) stay
+PUNCTUATION = string.punctuation + '’‘“”…'
+
+
+class Intent:
+    '''
+        What a message asks for.
+
+            :ivar text: the original text
+            :ivar start: the message contains the start command
+            :ivar stop: the message contains the stop command
+            :ivar rank: the message is the rank command alone
+            :ivar confirm: True for yes, False for no, None if neither or both
+            :ivar answer: True or False for the answer of a statement, None if it isn't clear
+            :ivar channel_id: the id of the first mentioned channel
+            :ivar channel_name: the name of the first mentioned channel
+    '''
+
+    __slots__ = ('text', 'start', 'stop', 'rank', 'confirm', 'answer', 'channel_id', 'channel_name')
+
+    def __init__(self, text):
+        self.text = text
+        self.start = False
+        self.stop = False
+        self.rank = False
+        self.confirm = None
+        self.answer = None
+        self.channel_id = None
+        self.channel_name = None
+
+    def __repr__(self):
+        return 'Intent({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def parse(text):
+    '''
+        Classifies a message in a single pass over its words.
+
+        A yes/no or truth word after a negation counts as its opposite ("it is not false" is true, "not sure" is
+        no), a message with both answers has none.
+
+            :param text: the text of the message
+            :type text: str
+            :rtype: Intent
+    '''
+    intent = Intent(text)
+    confirms = set()
+    answers = set()
+    words = 0
+    negated_until = -1
+    mentioned = False
+
+    lowered = text.lower()
+    if '#' in lowered:
+        match = MENTION.search(lowered)
+        if match is not None:
+            mentioned = True
+            if match.group(1) is not None:
+                # ids are upper case, lower-casing the whole text changed them
+                intent.channel_id = match.group(1).upper()
+                intent.channel_name = match.group(2) or None
+            else:
+                intent.channel_name = match.group(3)
+
+    # splitting on whitespace is several times faster than a word regex
+    for token in lowered.split():
+        if token[0] == '#' or token.startswith('<#'):
+            continue
+        word = token.strip(PUNCTUATION)
+        if not word:
+            continue
+
+        words += 1
+        kind = WORDS.get(word)
+        if kind is None:
+            if word in NEGATION_WORDS or word[-3:] in NEGATION_SUFFIXES:
+                negated_until = words + NEGATION_SCOPE
+        elif kind == 'start':
+            intent.start = True
+        elif kind == 'stop':
+            intent.stop = True
+        elif kind == 'rank':
+            intent.rank = True
+        elif kind == 'yes' or kind == 'no':
+            confirms.add((kind == 'yes') != (words <= negated_until))
+        else:
+            answers.add((kind == 'true') != (words <= negated_until))
+
+    intent.rank = intent.rank and words == 1 and not mentioned
+    if len(confirms) == 1:
+        intent.confirm = confirms.pop()
+    if len(answers) == 1:
+        intent.answer = answers.pop()
+    return intent
+
+
+# (text, expected attributes)
+CORPUS = [
+    ('start', {'start': True, 'stop': False, 'channel_id': None}),
+    ('Start', {'start': True}),
+    ('please start a game in #random', {'start': True, 'channel_name': 'random', 'channel_id': None}),
+    ('start <#C024BE7LR|general>', {'start': True, 'channel_id': 'C024BE7LR', 'channel_name': 'general'}),
+    ('start <#C024BE7LR>', {'start': True, 'channel_id': 'C024BE7LR', 'channel_name': None}),
+    ('stop', {'stop': True, 'start': False}),
+    ('STOP #team-a', {'stop': True, 'channel_name': 'team-a'}),
+    ('restart', {'start': False}),
+    ('yes', {'confirm': True}),
+    ('Yes, please', {'confirm': True}),
+    ('yep', {'confirm': True}),
+    ('no', {'confirm': False}),
+    ('nope', {'confirm': False}),
+    ('yes no', {'confirm': None}),
+    ('eyes', {'confirm': None}),
+    ('not sure', {'confirm': False}),
+    ('I am not ok with that', {'confirm': False}),
+    ('not ok', {'confirm': False}),
+    ("don't cancel", {'confirm': True}),
+    ('true', {'answer': True}),
+    ('TRUE', {'answer': True}),
+    ('false', {'answer': False}),
+    ('False.', {'answer': False}),
+    ('it is true', {'answer': True}),
+    ('it is not false', {'answer': True}),
+    ('it is not true', {'answer': False}),
+    ("that isn't true", {'answer': False}),
+    ('that isn’t false', {'answer': True}),
+    ('not really true', {'answer': False}),
+    ('not sure, but true', {'answer': True}),
+    ('true or false', {'answer': None}),
+    ('untrue', {'answer': None}),
+    ('i dunno', {'answer': None, 'confirm': None}),
+    ('rank', {'rank': True}),
+    (' Rank ', {'rank': True}),
+    ('my rank is low', {'rank': False}),
+    ('', {'start': False, 'stop': False, 'confirm': None, 'answer': None}),
+]
+
+
+def _check_corpus():
+    failures = []
+    for text, expected in CORPUS:
+        intent = parse(text)
+        for name, value in expected.items():
+            if getattr(intent, name) != value:
+                failures.append('{!r}: {} is {!r} instead of {!r}'.format(text, name, getattr(intent, name), value))
+    return failures
+
+
+def _parse_substrings(text):
+    # the checks of the message handlers before this module, for comparison
+    lowered = text.lower()
+    mentioned = re.search(r'<#(\w*)\|([a-zA-Z0-9_-]*)\>', text) or re.search('#([a-zA-Z0-9_-]*)', text)
+    return 'start' in lowered, 'stop' in lowered, 'yes' in lowered, 'true' in text.lower(), \
+        'false' in text.lower(), mentioned
+
+
+if __name__ == '__main__':
+    failures = _check_corpus()
+    for failure in failures:
+        print('FAIL ' + failure)
+    print('{} of {} corpus entries passed'.format(len(CORPUS) - len(set(f.split(':')[0] for f in failures)),
+                                                  len(CORPUS)))
+
+    # micro-benchmark on the messages of a game
+    messages = [text for text, _ in CORPUS] + ['What is the complexity of a hash map lookup in the worst case?'] * 8
+    for name, function in (('intents.parse', parse), ('substring checks', _parse_substrings)):
+        rounds = 20000
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for message in messages:
+                function(message)
+        elapsed = time.perf_counter() - started
+        print('{:<17} {:6.2f} us per message'.format(name, elapsed / (rounds * len(messages)) * 1e6))
+    raise SystemExit(1 if failures else 0)
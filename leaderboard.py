@@ -0,0 +1,178 @@
+import bisect
+import threading
+
+import pymongo
+
+
+def rank_players(players):
+    '''
+        Ranks players sorted by points in descending order, tied players share the rank (1, 1, 3, ...).
+
+            :param players: dicts with name and points
+            :type players: list
+            :return: (rank, name, points) tuples
+            :rtype: list
+    '''
+    ranked = []
+    for position, player in enumerate(players):
+        if ranked and ranked[-1][2] == player['points']:
+            rank = ranked[-1][0]
+        else:
+            rank = position + 1
+        ranked.append((rank, player['name'], player['points']))
+    return ranked
+
+
+class Ranking:
+    '''
+        Live ranking of the players of one game.
+
+        The players are grouped by points and the distinct point values are kept sorted, so a point change is a
+        bisect and the rank of a player only sums the group sizes above its points.
+    '''
+
+    def __init__(self):
+        self.points = {}
+        self.names = {}
+        self._groups = {}
+        self._scores = []
+        self._lock = threading.Lock()
+
+    def set(self, user_id, name, points):
+        with self._lock:
+            self._remove(user_id)
+            self.names[user_id] = name
+            self._insert(user_id, points)
+
+    def add(self, user_id, points):
+        with self._lock:
+            if user_id in self.points:
+                current = self.points[user_id]
+                self._remove(user_id)
+                self._insert(user_id, current + points)
+
+    def rank(self, user_id):
+        '''
+            Returns the rank of the player, None if the player isn't in the game.
+
+                :rtype: int
+        '''
+        with self._lock:
+            if user_id not in self.points:
+                return None
+            position = bisect.bisect_right(self._scores, self.points[user_id])
+            return 1 + sum(len(self._groups[score]) for score in self._scores[position:])
+
+    def top(self, count, max_tied):
+        '''
+            Returns the top players, tied players are ordered by name. At most max_tied players tied with the last
+            one are included too, the rest of them are only counted.
+
+                :param count: the number of players
+                :type count: int
+                :param max_tied: the number of players tied with the last one listed beyond count
+                :type max_tied: int
+                :return: (rank, name, points) tuples and the number of tied players left out
+                :rtype: tuple
+        '''
+        with self._lock:
+            players = []
+            more = 0
+            for score in reversed(self._scores):
+                if len(players) >= count:
+                    break
+                group = sorted(self._groups[score], key=lambda user_id: self.names[user_id])
+                listed = count - len(players) + max_tied
+                more = max(0, len(group) - listed)
+                players.extend({'name': self.names[user_id], 'points': score} for user_id in group[:listed])
+        return rank_players(players), more
+
+    def _insert(self, user_id, points):
+        self.points[user_id] = points
+        if points not in self._groups:
+            self._groups[points] = set()
+            bisect.insort(self._scores, points)
+        self._groups[points].add(user_id)
+
+    def _remove(self, user_id):
+        points = self.points.pop(user_id, None)
+        if points is None:
+            return
+        group = self._groups[points]
+        group.discard(user_id)
+        if not group:
+            del self._groups[points]
+            del self._scores[bisect.bisect_left(self._scores, points)]
+
+
+class Leaderboard:
+    '''
+        The rankings of the games.
+
+        The final standings come from an indexed points query of the players collection. Mid-game queries are
+        served from an in-memory Ranking per game, loaded on first use and updated when points change. When other
+        workers change the points as well (shared), the ranking is reloaded for every query.
+
+            :param collection: the players collection
+            :type collection: pymongo.collection.Collection
+    '''
+
+    def __init__(self, collection, shared=False):
+        self.collection = collection
+        self.shared = shared
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+    def ranking(self, game_id):
+        with self._lock:
+            ranking = self._rankings.get(game_id)
+        if ranking is None or self.shared:
+            ranking = self.load(game_id)
+        return ranking
+
+    def load(self, game_id):
+        ranking = Ranking()
+        for player in self.collection.find({'game': game_id}, {'id': True, 'name': True, 'points': True}):
+            ranking.set(player['id'], player['name'], player.get('points', 0))
+        with self._lock:
+            self._rankings[game_id] = ranking
+        return ranking
+
+    def reset(self, game_id, players):
+        '''
+            Starts a new ranking with zero points for the players of a new game.
+        '''
+        ranking = Ranking()
+        for player in players:
+            ranking.set(player['id'], player['name'], 0)
+        with self._lock:
+            self._rankings[game_id] = ranking
+
+    def add_points(self, game_id, user_id, points):
+        if not self.shared:
+            self.ranking(game_id).add(user_id, points)
+
+    def top(self, game_id, count, max_tied):
+        '''
+            Returns the top players of the game from the players collection in the order of Ranking.top, at most
+            max_tied players tied with the last one are included too, the rest of them are only counted.
+
+                :return: (rank, name, points) tuples and the number of tied players left out
+                :rtype: tuple
+        '''
+        projection = {'name': True, 'points': True}
+        players = list(
+            self.collection.find({'game': game_id}, projection)
+            .sort([('points', pymongo.DESCENDING), ('name', pymongo.ASCENDING)])
+            .limit(count)
+        )
+        more = 0
+        if players and len(players) == count:
+            points = players[-1]['points']
+            tied = {'game': game_id, 'points': points, '_id': {'$nin': [player['_id'] for player in players]}}
+            players.extend(
+                self.collection.find(tied, projection).sort('name', pymongo.ASCENDING).limit(max_tied)
+            )
+            listed = sum(1 for player in players if player['points'] == points)
+            more = max(0, self.collection.count_documents({'game': game_id, 'points': points}) - listed)
+        return rank_players(players), more
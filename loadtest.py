@@ -0,0 +1,387 @@
+'''
+    Offline load test: runs scripted games against a fake Slack workspace and an in-memory Mongo.
+
+    The bot runs unchanged, with its RTM runner, dispatcher and Web API clients, only the Slack client and the
+    database are replaced. Needs mongomock (pip install mongomock).
+
+        python loadtest.py --players 1000 --rounds 3 --max-p99-ms 250
+'''
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import redirect_stdout
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import app
+from messaging import METHOD_RATE_LIMITS, RateLimiter
+from rtm import RTMRunner
+from schema import ensure_indexes
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200, headers=None):
+        self.text = json.dumps(body)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSlack:
+    '''
+        In-process Slack workspace answering the Web API methods the bot uses and delivering RTM events.
+
+        Every call is counted, chat.postMessage calls are recorded with the reply latency to the last user message
+        of the channel. With rate_limits the per-minute limits of Slack's tiers are enforced and exceeding them is
+        answered with 429 and Retry-After, as Slack does.
+
+            :param users: the user profiles
+            :type users: list
+            :param channels: the public channels with id, name and members
+            :type channels: list
+    '''
+
+    def __init__(self, users, channels, rate_limits=False, api_latency=0.0):
+        self.users = users
+        self.channels = channels
+        self.rate_limits = rate_limits
+        self.api_latency = api_latency
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.posts = 0
+        self.latencies = []
+        self.groups = {}
+        self._pending = {}
+        self._windows = {}
+        self._events = deque()
+        self._lock = threading.Lock()
+        self.reader, self._writer = socket.socketpair()
+        self.reader.setblocking(False)
+
+    def login_data(self):
+        return {
+            'ok': True,
+            'self': {'id': 'UBOT', 'name': app.BOT_NAME},
+            'channels': [{'id': channel['id'], 'name': channel['name']} for channel in self.channels],
+            'groups': [],
+            'mpims': [],
+            'ims': [{'id': 'D' + user['id'], 'user': user['id']} for user in self.users]
+        }
+
+    def push(self, event):
+        '''
+            Delivers an RTM message event of a user.
+        '''
+        with self._lock:
+            self._pending.setdefault(event['channel'], []).append(time.perf_counter())
+        self._events.append(event)
+        self._writer.send(b'.')
+
+    def rtm_read(self):
+        try:
+            self.reader.recv(1)
+        except BlockingIOError:
+            return []
+        return [self._events.popleft()]
+
+    def do(self, token, request='?', post_data=None, domain='slack.com', timeout=None):
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        with self._lock:
+            self.calls[request] += 1
+            retry_after = self._rate_limit(request)
+            if retry_after:
+                self.rate_limited += 1
+                return FakeResponse({'ok': False, 'error': 'ratelimited'}, 429, {'Retry-After': str(retry_after)})
+        handler = getattr(self, '_' + request.replace('.', '_'), None)
+        if handler is None:
+            return FakeResponse({'ok': False, 'error': 'unknown_method'})
+        return FakeResponse(handler(**(post_data or {})))
+
+    def _rate_limit(self, method):
+        limit = METHOD_RATE_LIMITS.get(method, 20) if self.rate_limits else None
+        if limit is None:
+            return 0
+        now = time.monotonic()
+        window = self._windows.setdefault(method, deque())
+        while window and window[0] <= now - 60:
+            window.popleft()
+        if len(window) >= limit:
+            return int(window[0] + 60 - now) + 1
+        window.append(now)
+        return 0
+
+    def _page(self, items, key, limit=200, cursor=None, **kwargs):
+        start = int(cursor or 0)
+        end = start + int(limit)
+        return {
+            'ok': True,
+            key: items[start:end],
+            'response_metadata': {'next_cursor': str(end) if end < len(items) else ''}
+        }
+
+    def _users_list(self, **kwargs):
+        return self._page(self.users, 'members', **kwargs)
+
+    def _users_info(self, user, **kwargs):
+        for profile in self.users:
+            if profile['id'] == user:
+                return {'ok': True, 'user': profile}
+        return {'ok': False, 'error': 'user_not_found'}
+
+    def _channels_list(self, **kwargs):
+        return self._page([{'id': c['id'], 'name': c['name']} for c in self.channels], 'channels', **kwargs)
+
+    def _groups_list(self, **kwargs):
+        return self._page([], 'groups', **kwargs)
+
+    def _channels_info(self, channel, **kwargs):
+        for profile in self.channels:
+            if profile['id'] == channel:
+                return {'ok': True, 'channel': profile}
+        return {'ok': False, 'error': 'channel_not_found'}
+
+    def _groups_info(self, channel, **kwargs):
+        if channel in self.groups:
+            return {'ok': True, 'group': {'id': channel, 'is_mpim': True, 'members': self.groups[channel]}}
+        return {'ok': False, 'error': 'channel_not_found'}
+
+    def _im_open(self, user, **kwargs):
+        return {'ok': True, 'channel': {'id': 'D' + user}}
+
+    def _mpim_open(self, users, **kwargs):
+        members = sorted(users.split(','))
+        group_id = 'G' + ''.join(member[1:] for member in members)
+        self.groups[group_id] = members
+        return {'ok': True, 'group': {'id': group_id, 'is_mpim': True}}
+
+    def _chat_postMessage(self, channel, text, **kwargs):
+        now = time.perf_counter()
+        with self._lock:
+            self.posts += 1
+            for sent in self._pending.pop(channel, []):
+                self.latencies.append(now - sent)
+        return {'ok': True, 'channel': channel, 'ts': '{:.6f}'.format(time.time())}
+
+
+class FakeSlackClient:
+    '''
+        Stands in for slackclient.SlackClient, the Web API calls go through the requester as in the real client.
+    '''
+
+    class _Requester:
+        def __init__(self, do):
+            self.do = do
+
+    class _Server:
+        pass
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.token = 'xoxb-loadtest'
+        self.server = self._Server()
+        self.server.api_requester = self._Requester(fake.do)
+        self.server.login_data = None
+        self.server.websocket = self._Server()
+        self.server.websocket.sock = fake.reader
+        self.server.websocket.close = lambda: None
+
+    def api_call(self, method, timeout=None, **kwargs):
+        return json.loads(self.server.api_requester.do(self.token, method, kwargs, timeout=timeout).text)
+
+    def rtm_connect(self):
+        self.server.login_data = self.fake.login_data()
+        return True
+
+    def rtm_read(self):
+        return self.fake.rtm_read()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LoadTest:
+    '''
+        Plays one scripted game with synthetic players and measures every phase.
+
+        The players act in waves: everybody who has something to say sends one message at the same time, the next
+        wave starts when the bot handled all of them. A new day is simulated by clearing the last round dates and
+        running the daily pairing.
+    '''
+
+    def __init__(self, players, rounds, concurrency, rate_limits=False, api_latency=0.0):
+        self.rounds = rounds
+        self.concurrency = concurrency
+        users = [{'id': 'UADMIN', 'name': 'admin', 'is_admin': True, 'deleted': False, 'is_bot': False}]
+        users += [
+            {'id': 'U{}'.format(i), 'name': 'player{}'.format(i), 'is_admin': False, 'deleted': False,
+             'is_bot': False}
+            for i in range(players)
+        ]
+        channels = [{'id': 'CGENERAL', 'name': 'general', 'members': [user['id'] for user in users]}]
+        self.fake = FakeSlack(users, channels, rate_limits, api_latency)
+        self.client = FakeSlackClient(self.fake)
+        self.db = mongomock.MongoClient().db
+        self.rate_limits = rate_limits
+        self.runner = None
+        self.pushed = 0
+        self.phases = []
+
+    def run(self):
+        app.setup(self.client, self.db)
+        if not self.rate_limits:
+            app.web_client.limiter = RateLimiter(limits={}, default=None)
+        ensure_indexes(self.db)
+        app.games.load()
+        self.client.rtm_connect()
+        app.channel_registry.load(self.client.server.login_data)
+        app.user_directory.refresh()
+        app.conversations.load(self.client.server.login_data)
+
+        self.runner = RTMRunner(self.client, [app.parse_slack_output], concurrency=self.concurrency)
+        thread = threading.Thread(target=asyncio.run, args=(self.runner.run(),))
+        thread.start()
+        while self.runner.queue is None:
+            time.sleep(0.001)
+        try:
+            self.script()
+        finally:
+            self.runner.stop()
+            thread.join()
+
+    def script(self):
+        with self.phase('start'):
+            self.wave([('UADMIN', 'DUADMIN', 'start')])
+            self.wave([('UADMIN', 'DUADMIN', 'yes')])
+
+        with self.phase('setup'):
+            for number in range(3):
+                self.wave([(p['id'], 'D' + p['id'], 'statement {} of {}'.format(number, p['id']))
+                           for p in self.players('setup')])
+                self.wave([(p['id'], 'D' + p['id'], 'true' if number % 2 else 'false')
+                           for p in self.players('setup')])
+
+        for number in range(self.rounds):
+            with self.phase('round {}'.format(number + 1)):
+                if number > 0:
+                    # next day
+                    self.db['players'].update_many({}, {'$set': {'last_round': None}})
+                    app.do_daily('CGENERAL')
+                while True:
+                    answering = self.players('answer')
+                    if not answering:
+                        break
+                    self.wave([(p['id'], p['play_channel'], 'true') for p in answering])
+
+        with self.phase('stop'):
+            self.wave([('UADMIN', 'DUADMIN', 'stop')])
+            self.wave([('UADMIN', 'DUADMIN', 'yes')])
+
+    def players(self, status):
+        return list(self.db['players'].find({'game': 'CGENERAL', 'status': status}, {'id': True,
+                                                                                     'play_channel': True}))
+
+    def wave(self, messages):
+        for user_id, channel_id, text in messages:
+            self.fake.push({
+                'type': 'message', 'user': user_id, 'channel': channel_id, 'text': text,
+                'ts': '{:.6f}'.format(time.time())
+            })
+        self.pushed += len(messages)
+        while self.runner.dispatcher.handled < self.pushed:
+            time.sleep(0.001)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def report(self):
+        lines = ['{:<10} {:>8} {:>8} {:>10} {:>9} {:>9} {:>10}'.format(
+            'phase', 'events', 'posts', 'events/s', 'p50 ms', 'p99 ms', 'api calls')]
+        for phase in self.phases:
+            lines.append('{:<10} {:>8} {:>8} {:>10.1f} {:>9.1f} {:>9.1f} {:>10}'.format(
+                phase['name'], phase['events'], phase['posts'], phase['events'] / max(phase['seconds'], 1e-9),
+                phase['p50'] * 1000, phase['p99'] * 1000, phase['api_calls']))
+        total_events = sum(phase['events'] for phase in self.phases)
+        total_seconds = sum(phase['seconds'] for phase in self.phases)
+        lines.append('')
+        lines.append('{} events, {} posts in {:.2f} s: {:.1f} events/s, {:.1f} posts/s'.format(
+            total_events, self.fake.posts, total_seconds, total_events / max(total_seconds, 1e-9),
+            self.fake.posts / max(total_seconds, 1e-9)))
+        lines.append('reply latency p50 {:.1f} ms, p99 {:.1f} ms, rate limited calls {}'.format(
+            percentile(self.fake.latencies, 0.5) * 1000, percentile(self.fake.latencies, 0.99) * 1000,
+            self.fake.rate_limited))
+        lines.append('api calls: {}'.format(dict(self.fake.calls.most_common())))
+        return '\n'.join(lines)
+
+
+class _Phase:
+    def __init__(self, load_test, name):
+        self.load_test = load_test
+        self.name = name
+
+    def __enter__(self):
+        fake = self.load_test.fake
+        self.started = time.perf_counter()
+        self.pushed = self.load_test.pushed
+        self.posts = fake.posts
+        self.latencies = len(fake.latencies)
+        self.calls = sum(fake.calls.values())
+
+    def __exit__(self, *exc_info):
+        fake = self.load_test.fake
+        latencies = fake.latencies[self.latencies:]
+        self.load_test.phases.append({
+            'name': self.name,
+            'seconds': time.perf_counter() - self.started,
+            'events': self.load_test.pushed - self.pushed,
+            'posts': fake.posts - self.posts,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'api_calls': sum(fake.calls.values()) - self.calls
+        })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plays a scripted game against a fake Slack workspace.')
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=app.HANDLER_CONCURRENCY)
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help='simulated Web API round trip')
+    parser.add_argument('--rate-limits', action='store_true', help='enforce the rate limits of Slack\'s tiers')
+    parser.add_argument('--max-p99-ms', type=float, help='fail if the p99 reply latency is higher')
+    parser.add_argument('--max-calls-per-round', type=int, help='fail if a round makes more Web API calls')
+    args = parser.parse_args()
+
+    if mongomock is None:
+        sys.exit('The load test needs mongomock: pip install mongomock')
+
+    load_test = LoadTest(args.players, args.rounds, args.concurrency, args.rate_limits, args.api_latency_ms / 1000)
+    # the bot logs every message
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        load_test.run()
+    print(load_test.report())
+
+    failures = []
+    p99 = percentile(load_test.fake.latencies, 0.99) * 1000
+    if args.max_p99_ms is not None and p99 > args.max_p99_ms:
+        failures.append('p99 reply latency {:.1f} ms > {} ms'.format(p99, args.max_p99_ms))
+    for phase in load_test.phases:
+        if args.max_calls_per_round is not None and phase['name'].startswith('round') and \
+           phase['api_calls'] > args.max_calls_per_round:
+            failures.append('{} made {} Web API calls > {}'.format(
+                phase['name'], phase['api_calls'], args.max_calls_per_round))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    sys.exit(1 if failures else 0)
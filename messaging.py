@@ -0,0 +1,275 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+# Web API calls per minute allowed by Slack's rate limit tiers, None if the method has no workspace-wide limit
+METHOD_RATE_LIMITS = {
+    # chat.postMessage is limited to about one message per second in each channel instead
+    'chat.postMessage': None,
+    'im.open': 50,
+    'mpim.open': 50,
+    'users.info': 100,
+    'users.list': 20,
+    'channels.info': 50,
+    'channels.list': 20,
+    'groups.info': 50,
+    'groups.list': 20,
+}
+DEFAULT_RATE_LIMIT = 20
+
+
+class RateLimiter:
+    '''
+        Token bucket per Web API method, shared by the sender threads.
+
+        A bucket holds a minute's worth of calls, so short bursts go out at once and longer runs settle at the
+        tier's rate. pause() stops every method until the Retry-After of a rate limited response has passed.
+    '''
+
+    def __init__(self, limits=None, default=DEFAULT_RATE_LIMIT):
+        self.limits = METHOD_RATE_LIMITS if limits is None else limits
+        self.default = default
+        self._buckets = {}
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, method):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                limit = self.limits.get(method, self.default)
+                if limit is None and self._paused_until <= now:
+                    return
+                limit = limit or self.default
+                tokens, updated = self._buckets.get(method, (limit, now))
+                tokens = min(limit, tokens + (now - updated) * limit / 60.0)
+                delay = self._paused_until - now
+                if delay <= 0 and tokens >= 1:
+                    self._buckets[method] = (tokens - 1, now)
+                    return
+                self._buckets[method] = (tokens, now)
+                if delay <= 0:
+                    delay = (1 - tokens) * 60.0 / limit
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class ConversationCache:
+    '''
+        Channel ids of the bot's ims and mpims, keyed by the sorted user ids of the conversation.
+
+        The ids are stored in Mongo as well, so they survive restarts and a send only needs chat.postMessage.
+
+            :param collection: the collection storing the channel ids
+            :type collection: pymongo.collection.Collection
+    '''
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._channels = {}
+
+    @staticmethod
+    def key(user_ids):
+        return ','.join(sorted(user_ids))
+
+    def load(self, login_data=None):
+        '''
+            Fills the cache from Mongo and from the ims of the rtm.start response.
+        '''
+        for conversation in self.collection.find():
+            self._channels[conversation['key']] = conversation['channel_id']
+        if login_data:
+            self.load_ims(login_data)
+
+    def load_ims(self, login_data):
+        for im in login_data.get('ims', []):
+            if 'user' in im:
+                self._channels[im['user']] = im['id']
+
+    def get(self, user_ids):
+        return self._channels.get(self.key(user_ids))
+
+    def set(self, user_ids, channel_id):
+        key = self.key(user_ids)
+        if self._channels.get(key) != channel_id:
+            self._channels[key] = channel_id
+            self.collection.update_one({'key': key}, {'$set': {'channel_id': channel_id}}, upsert=True)
+
+    def invalidate(self, user_ids):
+        key = self.key(user_ids)
+        self._channels.pop(key, None)
+        self.collection.delete_one({'key': key})
+
+
+class SlackSender:
+    '''
+        Sends messages to ims and mpims, and can fan them out over a thread pool.
+
+            :param web_client: the Web API client
+            :type web_client: webapi.WebClient
+            :param conversations: the channel ids of the conversations
+            :type conversations: ConversationCache
+            :param concurrency: the number of calls in flight
+            :type concurrency: int
+    '''
+
+    def __init__(self, web_client, conversations, concurrency=8):
+        self.web_client = web_client
+        self.conversations = conversations
+        self.concurrency = concurrency
+
+    def call(self, method, **kwargs):
+        return self.web_client.call(method, **kwargs)
+
+    def open_conversation(self, user_ids):
+        '''
+            Returns the channel id of the im (one user) or mpim (more users) with the users.
+        '''
+        channel_id = self.conversations.get(user_ids)
+        if channel_id is None:
+            if len(user_ids) == 1:
+                channel_id = self.call('im.open', user=user_ids[0]).get('channel').get('id')
+            else:
+                channel_id = self.call('mpim.open', users=','.join(user_ids)).get('group').get('id')
+            self.conversations.set(user_ids, channel_id)
+        return channel_id
+
+    def send(self, user_ids, message, **kwargs):
+        '''
+            Sends a message to the im or mpim with the users.
+
+                :return: the channel id of the conversation
+                :rtype: str
+        '''
+        channel_id = self.open_conversation(user_ids)
+        try:
+            self.call('chat.postMessage', channel=channel_id, text=message, **kwargs)
+        except ValueError as e:
+            if e.args[1] != 'channel_not_found':
+                raise
+            # the cached channel is gone, open a new one
+            self.conversations.invalidate(user_ids)
+            channel_id = self.open_conversation(user_ids)
+            self.call('chat.postMessage', channel=channel_id, text=message, **kwargs)
+        return channel_id
+
+    def send_im(self, user_id, message, **kwargs):
+        return self.send([user_id], message, **kwargs)
+
+    def send_ims(self, user_ids, message, **kwargs):
+        '''
+            Sends the same message to every user concurrently.
+
+                :return: the users the message couldn't be sent to, with the errors
+                :rtype: dict
+        '''
+        def send(user_id):
+            try:
+                self.send_im(user_id, message, **kwargs)
+            except ValueError as e:
+                return user_id, e
+            return user_id, None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(send, user_ids)
+            return {user_id: error for user_id, error in results if error is not None}
+
+
+class Outbox:
+    '''
+        Collects the messages sent while handling one event and sends them per conversation as a single post.
+
+        The messages of a conversation are joined in order as lines of one message, the conversations are posted
+        in the order of their first message. Handlers run on separate threads, so every thread has its own
+        buffer. Outside of collect() the messages are sent right away.
+
+            :param sender: sends the messages to ims and mpims
+            :type sender: SlackSender
+            :param on_post: called after every post, optional
+            :type on_post: callable
+    '''
+
+    def __init__(self, sender, on_post=None, separator='\n'):
+        self.sender = sender
+        self.on_post = on_post
+        self.separator = separator
+        self.posts = 0
+        self.messages = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def collect(self):
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            self._local.buffer = OrderedDict()
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                # the messages collected before an error are still sent, as they would have been without the outbox
+                self.flush()
+                self._local.buffer = None
+
+    def flush(self):
+        '''
+            Sends the messages collected so far on this thread, before messages that don't go through the outbox.
+        '''
+        buffer = getattr(self._local, 'buffer', None)
+        if not buffer:
+            return
+        self._local.buffer = OrderedDict()
+        for post, messages in buffer.values():
+            self._post(post, self.separator.join(messages))
+
+    def discard(self):
+        '''
+            Drops the messages collected so far on this thread.
+        '''
+        if getattr(self._local, 'buffer', None):
+            self._local.buffer = OrderedDict()
+
+    def send(self, user_ids, message, **kwargs):
+        '''
+            Sends a message to the im or mpim with the users.
+
+                :return: the channel id of the conversation
+                :rtype: str
+        '''
+        channel_id = self.sender.open_conversation(user_ids)
+        self._add(channel_id, message, kwargs, lambda text: self.sender.send(user_ids, text, **kwargs))
+        return channel_id
+
+    def post(self, channel_id, message, **kwargs):
+        '''
+            Sends a message to a channel.
+        '''
+        self._add(
+            channel_id, message, kwargs,
+            lambda text: self.sender.call('chat.postMessage', channel=channel_id, text=text, **kwargs)
+        )
+
+    def _add(self, channel_id, message, kwargs, post):
+        self.messages += 1
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            self._post(post, message)
+            return
+        # messages with different options (username, parse, ...) can't share a post
+        key = (channel_id, tuple(sorted(kwargs.items())))
+        if key not in buffer:
+            buffer[key] = (post, [])
+        buffer[key][1].append(message)
+
+    def _post(self, post, text):
+        post(text)
+        self.posts += 1
+        if self.on_post is not None:
+            self.on_post()
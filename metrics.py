@@ -0,0 +1,230 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pymongo import monitoring
+
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+    '''
+        Latency histogram with fixed buckets, as in Prometheus.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        '''
+            Returns the upper bound of the bucket the quantile falls into.
+        '''
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    '''
+        Counters and latency histograms by name and label values, rendered in the Prometheus text format.
+
+        Recording is a dict lookup and a few additions under a lock, so it can wrap every Web API and database
+        call. The latency from a Slack event to the first reply is measured per handler thread between
+        start_event() and replied().
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def inc(self, name, labels, value=1):
+        '''
+            :param name: the name of the counter
+            :type name: str
+            :param labels: the label names and values
+            :type labels: tuple
+        '''
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - started)
+
+    def start_event(self, event):
+        '''
+            Starts measuring the reply latency of an event on the current thread.
+        '''
+        try:
+            self._local.event_ts = float(event['ts'])
+        except (KeyError, TypeError, ValueError):
+            self._local.event_ts = None
+
+    def replied(self):
+        '''
+            Records the latency of the first reply to the event handled on the current thread.
+        '''
+        event_ts = getattr(self._local, 'event_ts', None)
+        if event_ts is not None:
+            self._local.event_ts = None
+            # the event timestamp comes from Slack's clock, so the latency includes the delivery as well
+            self.observe('questionbot_event_reply_seconds', (), max(0.0, time.time() - event_ts))
+
+    def instrument_requester(self, do):
+        '''
+            Wraps the Web API requester of the Slack client, which every Web API call goes through.
+
+                :param do: the do method of slackclient's SlackRequest
+                :type do: callable
+        '''
+        def instrumented(token, request='?', *args, **kwargs):
+            labels = (('method', request),)
+            self.inc('questionbot_slack_calls_total', labels)
+            started = time.perf_counter()
+            try:
+                response = do(token, request, *args, **kwargs)
+            except Exception:
+                self.inc('questionbot_slack_errors_total', labels + (('error', 'exception'),))
+                raise
+            finally:
+                self.observe('questionbot_slack_call_seconds', labels, time.perf_counter() - started)
+            if response.status_code == 429:
+                self.inc('questionbot_slack_rate_limited_total', labels)
+            return response
+        return instrumented
+
+    def count_api_error(self, method, error):
+        self.inc('questionbot_slack_errors_total', (('method', method), ('error', str(error))))
+
+    def command_listener(self):
+        '''
+            Returns a pymongo command listener recording the database calls by command and collection.
+        '''
+        return _CommandListener(self)
+
+    def render(self):
+        '''
+            Returns the metrics in the Prometheus text format.
+
+                :rtype: str
+        '''
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(histogram.counts), histogram.count, histogram.sum)
+                for key, histogram in self.histograms.items()
+            )
+
+        lines = []
+        for (name, labels), value in counters:
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        for (name, labels), counts, count, total in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''
+            Returns the call counts and the approximate median and 99th percentile latencies, for the log.
+
+                :rtype: dict
+        '''
+        with self._lock:
+            return {
+                '{}{}'.format(name, _labels(labels)): {
+                    'count': histogram.count,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99)
+                }
+                for (name, labels), histogram in sorted(self.histograms.items())
+            }
+
+    def serve(self, port, host='127.0.0.1'):
+        '''
+            Serves the metrics on http://host:port/metrics from a daemon thread.
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class _CommandListener(monitoring.CommandListener):
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event):
+        self._record(event, self._collections.pop(event.request_id, ''))
+
+    def failed(self, event):
+        collection = self._collections.pop(event.request_id, '')
+        self._record(event, collection)
+        self.metrics.inc('questionbot_db_errors_total', (('command', event.command_name), ('collection', collection)))
+
+    def _record(self, event, collection):
+        labels = (('command', event.command_name), ('collection', collection))
+        self.metrics.inc('questionbot_db_calls_total', labels)
+        self.metrics.observe('questionbot_db_call_seconds', labels, event.duration_micros / 1e6)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + '}'
@@ -0,0 +1,216 @@
+import random
+import time
+from collections import deque
+
+from records import Player, user_ids
+
+
+def match_greedy(players):
+    '''
+        Pairs up the players in the given order, each with the first following player they haven't played with.
+
+        The result is a maximal matching: no two players left unpaired could be paired with each other. The unpaired
+        players are kept in a linked list, so a player only skips its previous opponents and the whole pass is
+        O(n + number of previous opponents) after sorting.
+
+            :param players: the eligible players as Player records, sorted by priority
+            :type players: list
+            :return: the pairs of player ids
+            :rtype: list
+    '''
+    count = len(players)
+    # linked list of the unpaired players, count is the end marker
+    next_index = list(range(1, count + 1))
+    previous_index = list(range(-1, count - 1))
+
+    def unlink(index):
+        if previous_index[index] >= 0:
+            next_index[previous_index[index]] = next_index[index]
+        if next_index[index] < count:
+            previous_index[next_index[index]] = previous_index[index]
+
+    pairs = []
+    head = 0
+    while head < count:
+        player = head
+        candidate = next_index[player]
+        while candidate < count and players[player].has_played(players[candidate].uid):
+            candidate = next_index[candidate]
+
+        head = next_index[player]
+        unlink(player)
+        if candidate < count:
+            if candidate == head:
+                head = next_index[candidate]
+            unlink(candidate)
+            pairs.append((players[player].id, players[candidate].id))
+
+    return pairs
+
+
+# the largest pool the exact search runs on, about 0.1 s in the worst case
+BLOSSOM_LIMIT = 300
+
+
+def match_maximum(players):
+    '''
+        Pairs up as many players as possible, preferring the players earlier in the given order.
+
+        Starts from the greedy matching and extends it with augmenting paths, which never unpair a paired player,
+        so the players with fewer rounds (earlier in the order) are the ones who get paired when somebody has to
+        sit out. Players may only be paired with non-opponents, so every matched pair blocking a short
+        augmenting path between two unpaired players must contain one of their opponents, and short paths
+        usually exist. Players who have played everyone else in the pool can't be paired at all and are left
+        out of the search. When more than one pairable player is still unpaired, the exact blossom search runs
+        from each of them, but only in pools of at most BLOSSOM_LIMIT players: its neighbours are the
+        non-opponents, listed on demand, so it needs O(n) memory but up to O(n^2) time per unpaired player.
+        Bigger pools keep the result of the short paths, which is maximal and almost always maximum.
+
+            :param players: the eligible players as Player records, sorted by priority
+            :type players: list
+            :return: the pairs of player ids
+            :rtype: list
+    '''
+    ids = [player.id for player in players]
+    index = {user_id: i for i, user_id in enumerate(ids)}
+    positions = {player.uid: i for i, player in enumerate(players)}
+    opponents = [
+        {positions[opponent] for opponent in player.opponents if opponent in positions} for player in players
+    ]
+    count = len(ids)
+
+    match = [-1] * count
+    for user_id_1, user_id_2 in match_greedy(players):
+        match[index[user_id_1]] = index[user_id_2]
+        match[index[user_id_2]] = index[user_id_1]
+
+    # nobody is left to pair with a player who has played everyone in the pool
+    pairable = [len(opponents[i]) < count - 1 for i in range(count)]
+
+    # augmenting paths of length 3: u - a = b - v becomes u = a, b = v
+    augmented = True
+    while augmented:
+        augmented = False
+        unmatched = [i for i in range(count) if match[i] == -1 and pairable[i]]
+        for position, u in enumerate(unmatched):
+            for v in unmatched[position + 1:]:
+                if match[u] != -1 or match[v] != -1:
+                    continue
+                for a in range(count):
+                    b = match[a]
+                    if b == -1 or a in opponents[u] or b in opponents[v]:
+                        continue
+                    match[u], match[a] = a, u
+                    match[v], match[b] = b, v
+                    augmented = True
+                    break
+
+    roots = [i for i in range(count) if match[i] == -1 and pairable[i]]
+    if 1 < len(roots) and count <= BLOSSOM_LIMIT:
+        def neighbours(v):
+            return (to for to in range(count) if pairable[to] and to != v and to not in opponents[v])
+
+        for root in roots:
+            if match[root] == -1 and not _augment(neighbours, count, match, root):
+                # a root without an augmenting path never gets one, so later searches can skip it
+                pairable[root] = False
+
+    return [(ids[i], ids[match[i]]) for i in range(count) if match[i] > i]
+
+
+def _augment(neighbours, count, match, root):
+    # Edmonds' blossom algorithm: searches an augmenting path from root and applies it to match
+    used = [False] * count
+    parent = [-1] * count
+    base = list(range(count))
+
+    def lowest_common_ancestor(a, b):
+        seen = [False] * count
+        while True:
+            a = base[a]
+            seen[a] = True
+            if match[a] == -1:
+                break
+            a = parent[match[a]]
+        while True:
+            b = base[b]
+            if seen[b]:
+                return b
+            b = parent[match[b]]
+
+    def mark_path(v, blossom_base, child, blossom):
+        while base[v] != blossom_base:
+            blossom[base[v]] = blossom[base[match[v]]] = True
+            parent[v] = child
+            child = match[v]
+            v = parent[match[v]]
+
+    used[root] = True
+    queue = deque([root])
+    while queue:
+        v = queue.popleft()
+        for to in neighbours(v):
+            if base[v] == base[to] or match[v] == to:
+                continue
+            if to == root or (match[to] != -1 and parent[match[to]] != -1):
+                blossom_base = lowest_common_ancestor(v, to)
+                blossom = [False] * count
+                mark_path(v, blossom_base, to, blossom)
+                mark_path(to, blossom_base, v, blossom)
+                for i in range(count):
+                    if blossom[base[i]]:
+                        base[i] = blossom_base
+                        if not used[i]:
+                            used[i] = True
+                            queue.append(i)
+            elif parent[to] == -1:
+                parent[to] = v
+                if match[to] == -1:
+                    # flip the path back to the root
+                    while to != -1:
+                        previous = parent[to]
+                        next_to = match[previous]
+                        match[to] = previous
+                        match[previous] = to
+                        to = next_to
+                    return True
+                used[match[to]] = True
+                queue.append(match[to])
+    return False
+
+
+STRATEGIES = {
+    'greedy': match_greedy,
+    'maximum': match_maximum,
+}
+
+
+def _synthetic_pool(size, rounds, seed):
+    # players who joined late have few opponents, veterans have played up to `rounds` others
+    rng = random.Random(seed)
+    ids = ['U{}'.format(i) for i in range(size)]
+    opponents = {user_id: set() for user_id in ids}
+    for user_id in ids:
+        for opponent in rng.sample(ids, min(size - 1, rng.randint(0, rounds))):
+            if opponent != user_id:
+                opponents[user_id].add(opponent)
+                opponents[opponent].add(user_id)
+    players = []
+    for user_id in ids:
+        player = Player(user_id, 'C0')
+        for opponent in opponents[user_id]:
+            player.add_opponent(user_ids.number(opponent))
+        player.rounds = len(opponents[user_id])
+        players.append(player)
+    return sorted(players, key=lambda player: player.rounds)
+
+
+if __name__ == '__main__':
+    # benchmark: pairs formed and runtime of the strategies on synthetic pools
+    for size, rounds in ((100, 60), (1000, 40), (10000, 20)):
+        pool = _synthetic_pool(size, rounds, seed=size)
+        for name, strategy in sorted(STRATEGIES.items()):
+            start = time.perf_counter()
+            pairs = strategy(pool)
+            elapsed = time.perf_counter() - start
+            print('{:>6} players, {:<8} {:>5} pairs in {:8.1f} ms'.format(size, name, len(pairs), elapsed * 1000))
@@ -1,10 +1,9 @@
-import os
-from slackclient import SlackClient
+from bootstrap import create_slack_client
 
 
 BOT_NAME = 'questionbot'
 
-slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
+slack_client = create_slack_client()
 
 if __name__ == "__main__":
     api_call = slack_client.api_call("users.list")
@@ -15,4 +14,4 @@ if __name__ == "__main__":
             if 'name' in user and user.get('name') == BOT_NAME:
                 print("Bot ID for '" + user['name'] + "' is " + user.get('id'))
     else:
-        print("could not find bot user with the name " + BOT_NAME)
\ No newline at end of file
+        print("could not find bot user with the name " + BOT_NAME)
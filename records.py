@@ -0,0 +1,232 @@
+import bisect
+import random
+import sys
+import threading
+import tracemalloc
+from array import array
+from datetime import datetime
+
+
+class UserIds:
+    '''
+        Interns Slack user ids as small integers, an id keeps its number for the lifetime of the process.
+    '''
+
+    def __init__(self):
+        self._numbers = {}
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def number(self, user_id):
+        number = self._numbers.get(user_id)
+        if number is None:
+            with self._lock:
+                number = self._numbers.get(user_id)
+                if number is None:
+                    number = len(self._ids)
+                    self._ids.append(user_id)
+                    self._numbers[user_id] = number
+        return number
+
+    def numbers(self, user_ids):
+        '''
+            Returns the numbers of the user ids, with a single lookup each when they are all interned already.
+        '''
+        numbers = self._numbers
+        try:
+            return [numbers[user_id] for user_id in user_ids]
+        except KeyError:
+            return [self.number(user_id) for user_id in user_ids]
+
+    def user_id(self, number):
+        return self._ids[number]
+
+    def __len__(self):
+        return len(self._ids)
+
+
+# the user ids of the workspace, shared by every record
+user_ids = UserIds()
+
+
+class Player:
+    '''
+        Compact in-memory record of a player document.
+
+        User ids are interned as integers. The opponents are kept in play order in an array, next to a sorted copy
+        for the membership checks of the pairing, so has_played() is a bisect over the few opponents of the
+        player. Fields the record doesn't know are kept in extra, so to_document() gives back the document
+        from_document() was made of.
+
+            :ivar uid: the interned user id
+            :ivar opponents: the interned ids of the opponents in play order
+    '''
+
+    __slots__ = (
+        '_id', 'uid', 'game', 'name', 'status', 'current_question_num', 'questions', 'answers', 'rounds',
+        'last_round', 'opponents', '_played', 'play_channel', 'points', 'extra'
+    )
+    # document fields in the order start_game writes them
+    FIELDS = (
+        'game', 'id', 'name', 'status', 'current_question_num', 'questions', 'answers', 'rounds', 'last_round',
+        'opponents', 'play_channel', 'points'
+    )
+
+    # the fields of the players collection read by for_pairing()
+    PAIRING_PROJECTION = {'_id': False, 'id': True, 'game': True, 'rounds': True, 'opponents': True}
+
+    def __init__(self, user_id, game, name=None):
+        self._id = None
+        self.uid = user_ids.number(user_id)
+        self.game = sys.intern(game)
+        self.name = name
+        self.status = 'setup'
+        self.current_question_num = 0
+        self.questions = ()
+        self.answers = ()
+        self.rounds = 0
+        self.last_round = None
+        self.opponents = array('I')
+        self._played = array('I')
+        self.play_channel = None
+        self.points = 0
+        self.extra = None
+
+    @property
+    def id(self):
+        return user_ids.user_id(self.uid)
+
+    def has_played(self, uid):
+        '''
+            Tells whether the player has played with the player of the interned id.
+        '''
+        position = bisect.bisect_left(self._played, uid)
+        return position < len(self._played) and self._played[position] == uid
+
+    def add_opponent(self, uid):
+        self.opponents.append(uid)
+        if not self.has_played(uid):
+            self._played.insert(bisect.bisect_left(self._played, uid), uid)
+
+    def _set_opponents(self, opponents):
+        # one sort instead of an insert per opponent
+        if opponents:
+            numbers = user_ids.numbers(opponents)
+            self.opponents = array('I', numbers)
+            self._played = array('I', sorted(numbers))
+
+    @classmethod
+    def from_document(cls, document):
+        '''
+            Makes a record of a player document of the players collection.
+
+                :type document: dict
+                :rtype: Player
+        '''
+        player = cls(document['id'], document['game'], document.get('name'))
+        if '_id' in document:
+            player._id = document['_id']
+        player.status = sys.intern(document['status'])
+        player.current_question_num = document['current_question_num']
+        player.questions = tuple(document['questions'])
+        player.answers = tuple(document['answers'])
+        player.rounds = document['rounds']
+        player.last_round = document['last_round']
+        player._set_opponents(document['opponents'])
+        player.play_channel = document['play_channel']
+        player.points = document['points']
+        extra = {key: value for key, value in document.items() if key != '_id' and key not in cls.FIELDS}
+        player.extra = extra or None
+        return player
+
+    @classmethod
+    def for_pairing(cls, document):
+        '''
+            Makes a record of the fields the pairing reads, from a document projected to PAIRING_PROJECTION. It
+            can't be turned back into a player document.
+
+                :type document: dict
+                :rtype: Player
+        '''
+        player = cls(document['id'], document['game'])
+        player.rounds = document['rounds']
+        player._set_opponents(document['opponents'])
+        return player
+
+    def to_document(self):
+        '''
+            Returns the player document of the record.
+
+                :rtype: dict
+        '''
+        document = {} if self._id is None else {'_id': self._id}
+        document.update({
+            'game': self.game,
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'current_question_num': self.current_question_num,
+            'questions': list(self.questions),
+            'answers': list(self.answers),
+            'rounds': self.rounds,
+            'last_round': self.last_round,
+            'opponents': [user_ids.user_id(uid) for uid in self.opponents],
+            'play_channel': self.play_channel,
+            'points': self.points
+        })
+        if self.extra:
+            document.update(self.extra)
+        return document
+
+    def __repr__(self):
+        return 'Player({!r}, {!r}, status={!r})'.format(self.id, self.game, self.status)
+
+
+def _synthetic_documents(size, rounds, seed):
+    # documents as the players collection returns them, every string is a separate object like after decoding BSON
+    rng = random.Random(seed)
+    ids = ['U{:08d}'.format(i) for i in range(size)]
+    last_round = datetime(2020, 1, 1)
+    documents = []
+    for number, user_id in enumerate(ids):
+        documents.append({
+            '_id': number,
+            'game': ''.join('C0123GAME'),
+            'id': ''.join(user_id),
+            'name': 'player{}'.format(user_id),
+            'status': ''.join('ready'),
+            'current_question_num': 0,
+            'questions': ['Is question number {} of {} true?'.format(i, user_id) for i in range(3)],
+            'answers': [rng.random() < 0.5 for _ in range(3)],
+            'rounds': rounds,
+            'last_round': last_round,
+            'opponents': [''.join(opponent) for opponent in rng.sample(ids, rounds)],
+            'play_channel': None,
+            'points': rng.randint(0, rounds * 3)
+        })
+    return documents
+
+
+def _allocated(build):
+    tracemalloc.start()
+    try:
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    # memory benchmark: bytes per player of the documents and of the records made of them at 10k players
+    size = 10000
+    for rounds in (0, 20, 60):
+        # the ids are interned beforehand, the records of every game share them
+        for user_id in ('U{:08d}'.format(i) for i in range(size)):
+            user_ids.number(user_id)
+        documents, document_bytes = _allocated(lambda: _synthetic_documents(size, rounds, seed=rounds))
+        records, record_bytes = _allocated(
+            lambda: [Player.from_document(document) for document in _synthetic_documents(size, rounds, seed=rounds)]
+        )
+        assert all(record.to_document() == document for record, document in zip(records, documents))
+        print('{:>6} players, {:>2} opponents: documents {:>6.0f} bytes, records {:>6.0f} bytes per player'.format(
+            size, rounds, document_bytes / size, record_bytes / size))
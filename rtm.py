@@ -0,0 +1,221 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def event_keys(event):
+    '''
+        Returns the ordering keys of an event: the user and the channel it belongs to.
+
+            :param event: an RTM event
+            :type event: dict
+            :rtype: tuple
+    '''
+    keys = []
+    for field in ('user', 'channel'):
+        value = event.get(field)
+        if isinstance(value, dict):
+            value = value.get('id')
+        if value:
+            keys.append(value)
+    # events without user and channel (hello, reconnect_url, ...) are ordered among themselves
+    return tuple(keys) or ('',)
+
+
+class _Entry:
+    __slots__ = ('event', 'keys', 'queued', 'started')
+
+    def __init__(self, event, keys, queued):
+        self.event = event
+        self.keys = keys
+        self.queued = queued
+        self.started = False
+
+
+class Dispatcher:
+    '''
+        Runs the handler chain for events on a worker pool.
+
+        Every event waits in one FIFO queue per ordering key (user and channel id) and starts only when it is at the
+        head of all of its queues, so the events of one user or one conversation are handled in order while
+        unrelated players are handled concurrently.
+
+            :param handlers: callables receiving a list of RTM events, in call order
+            :type handlers: list
+            :param concurrency: the number of worker threads
+            :type concurrency: int
+            :param log: logs the failures of the handlers, a failed event doesn't stop the others
+            :type log: callable
+    '''
+
+    def __init__(self, handlers, concurrency, log=print):
+        self.handlers = handlers
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.log = log
+        self._loop = None
+        self._queues = {}
+        self._queued = 0
+        self._running = 0
+        self.handled = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, event):
+        '''
+            Queues an event, must be called from the event loop.
+        '''
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        entry = _Entry(event, event_keys(event), time.monotonic())
+        for key in entry.keys:
+            self._queues.setdefault(key, deque()).append(entry)
+        self._queued += 1
+        self.max_depth = max(self.max_depth, self._queued)
+        self._try_start(entry)
+
+    def _try_start(self, entry):
+        if entry.started or any(self._queues[key][0] is not entry for key in entry.keys):
+            return
+        entry.started = True
+        self._queued -= 1
+        self._running += 1
+
+        wait = time.monotonic() - entry.queued
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+        future = self._loop.run_in_executor(self.executor, self._handle, entry.event)
+        future.add_done_callback(lambda f: self._done(entry, f))
+
+    def _handle(self, event):
+        for handler in self.handlers:
+            handler([event])
+
+    def _done(self, entry, future):
+        self._running -= 1
+        self.handled += 1
+        if not future.cancelled() and future.exception() is not None:
+            self.log('EVENT', 'Event handling failed: {}'.format(future.exception()))
+
+        for key in entry.keys:
+            queue = self._queues[key]
+            queue.popleft()
+            if not queue:
+                del self._queues[key]
+        for key in entry.keys:
+            if key in self._queues:
+                self._try_start(self._queues[key][0])
+
+    def stats(self):
+        return {
+            'queued': self._queued,
+            'running': self._running,
+            'handled': self.handled,
+            'max_depth': self.max_depth,
+            'wait_avg': self.wait_total / self.handled if self.handled else 0.0,
+            'wait_max': self.wait_max
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class RTMRunner:
+    '''
+        Event-driven reader for the Slack RTM websocket.
+
+        The websocket is read only when its socket becomes readable and the events are put on a queue, from which
+        they are handed to the Dispatcher. Handlers are blocking, so they run on its worker threads while the event
+        loop keeps reading the socket. The blocking calls of the jobs run on a thread of their own, so a long job
+        (the daily pairing) doesn't hold up the handlers.
+
+            :param slack_client: a connected SlackClient
+            :type slack_client: slackclient.SlackClient
+            :param handlers: callables receiving a list of RTM events, in call order
+            :type handlers: list
+            :param concurrency: the number of events handled at the same time
+            :type concurrency: int
+            :param log: logs the failures of the handlers
+            :type log: callable
+    '''
+
+    def __init__(self, slack_client, handlers, concurrency=1, log=print):
+        self.slack_client = slack_client
+        self.dispatcher = Dispatcher(handlers, concurrency, log)
+        self.job_executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self._loop = None
+        self._closed = None
+
+    async def run(self, *jobs):
+        '''
+            Runs until the websocket is closed or the reader or a job fails, a failed handler is only logged.
+
+                :param jobs: coroutine functions started next to the reader, they receive the runner
+        '''
+        self._loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self._closed = self._loop.create_future()
+
+        sock = self.slack_client.server.websocket.sock
+        self._loop.add_reader(sock.fileno(), self._on_readable)
+        # frames could have arrived between connecting and registering the reader
+        self._on_readable()
+
+        tasks = [asyncio.ensure_future(self._consume())] + [asyncio.ensure_future(job(self)) for job in jobs]
+        for task in tasks:
+            task.add_done_callback(self._task_done)
+        try:
+            await self._closed
+        finally:
+            self._loop.remove_reader(sock.fileno())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.dispatcher.shutdown()
+            self.job_executor.shutdown(wait=True)
+
+    async def call(self, func, *args):
+        '''
+            Runs a blocking function of a job on the job thread, the calls of the jobs run one at a time.
+        '''
+        return await self._loop.run_in_executor(self.job_executor, func, *args)
+
+    def stop(self):
+        '''
+            Stops the runner after the running handlers finish, can be called from any thread.
+        '''
+        self._loop.call_soon_threadsafe(lambda: self._closed.done() or self._closed.set_result(None))
+
+    def stats(self):
+        stats = self.dispatcher.stats()
+        stats['incoming'] = self.queue.qsize() if self.queue is not None else 0
+        return stats
+
+    def _task_done(self, task):
+        # the reader and the jobs run forever, so a finished task failed
+        if not task.cancelled() and task.exception() is not None:
+            self._close(task.exception())
+
+    def _close(self, e):
+        if not self._closed.done():
+            self._closed.set_exception(e)
+
+    def _on_readable(self):
+        try:
+            # one rtm_read returns one frame, so drain everything that is buffered
+            while True:
+                events = self.slack_client.rtm_read()
+                if not events:
+                    break
+                for event in events:
+                    self.queue.put_nowait(event)
+        except Exception as e:
+            self._close(e)
+
+    async def _consume(self):
+        while True:
+            event = await self.queue.get()
+            self.dispatcher.submit(event)
@@ -0,0 +1,141 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta, timezone
+
+
+class Job:
+    '''
+        A scheduled job.
+
+            :param name: unique name, the last run is stored under it
+            :type name: str
+            :param next_run: callable receiving the last run (aware datetime or None) and returning the next run or
+                None if the job shouldn't run anymore
+            :type next_run: callable
+            :param func: blocking callable running the job
+            :type func: callable
+    '''
+
+    def __init__(self, name, next_run, func):
+        self.name = name
+        self.next_run = next_run
+        self.func = func
+
+
+def daily(hour, tz=None):
+    '''
+        Returns a next_run function for a job running every day at the given hour of the time zone.
+
+        A missed run (the process was down at that hour) is made up for right away.
+
+            :param hour: the hour of the day
+            :type hour: int
+            :param tz: the time zone, local time if None
+            :type tz: datetime.tzinfo
+    '''
+    def next_run(last_run):
+        now = datetime.now(timezone.utc).astimezone(tz)
+        today = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if last_run is None:
+            # first run of the job, it is due only from its next hour on
+            return today if today > now else today + timedelta(days=1)
+        due = today if today <= now else today - timedelta(days=1)
+        return due if last_run < due else due + timedelta(days=1)
+    return next_run
+
+
+def once(when):
+    '''
+        Returns a next_run function for a job running a single time.
+    '''
+    def next_run(last_run):
+        return when if last_run is None or last_run < when else None
+    return next_run
+
+
+class Scheduler:
+    '''
+        Runs the jobs at their deadlines on the event loop.
+
+        The jobs are kept in a heap by their next run and the scheduler sleeps until the nearest one, so it doesn't
+        wake up between deadlines. The last runs are stored in Mongo, so a restart neither repeats nor skips a run.
+        The job list is rebuilt after every run and on reschedule(). A run is stored only when the job succeeds, a
+        failed job is logged and stays due, it is retried after retry_delay.
+
+            :param collection: the collection storing the last runs
+            :type collection: pymongo.collection.Collection
+            :param jobs: callable returning the current jobs
+            :type jobs: callable
+            :param max_sleep: seconds after which the job list is rebuilt anyway
+            :type max_sleep: float
+            :param retry_delay: seconds after which a failed job is run again
+            :type retry_delay: float
+    '''
+
+    def __init__(self, collection, jobs, max_sleep=60 * 60, retry_delay=5 * 60, log=print):
+        self.collection = collection
+        self.jobs = jobs
+        self.max_sleep = max_sleep
+        self.retry_delay = retry_delay
+        self.log = log
+        self.last_runs = {}
+        self._retries = {}
+        self._loop = None
+        self._changed = None
+
+    def load(self):
+        self.last_runs = {
+            job['name']: job['last_run'].replace(tzinfo=timezone.utc) for job in self.collection.find()
+        }
+
+    def reschedule(self):
+        '''
+            Rebuilds the job list, can be called from any thread.
+        '''
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def run(self, runner):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self.load()
+        while True:
+            self._changed.clear()
+            jobs = await runner.call(self.jobs)
+            heap = []
+            for job in jobs:
+                when = job.next_run(self.last_runs.get(job.name))
+                if when is not None and job.name in self._retries:
+                    when = max(when, self._retries[job.name])
+                if when is not None:
+                    heap.append((when, job.name, job))
+            heapq.heapify(heap)
+
+            now = datetime.now(timezone.utc)
+            delay = self.max_sleep
+            if heap:
+                delay = min(delay, max(0.0, (heap[0][0] - now).total_seconds()))
+            try:
+                await asyncio.wait_for(self._changed.wait(), delay)
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            while heap and heap[0][0] <= datetime.now(timezone.utc):
+                when, name, job = heapq.heappop(heap)
+                self.log('SCHEDULER', 'Running {} due at {}.'.format(name, when))
+                try:
+                    await runner.call(job.func)
+                except Exception as e:
+                    self.log('SCHEDULER', 'Job {} failed, retrying in {} seconds: {}'.format(name, self.retry_delay, e))
+                    self._retries[name] = datetime.now(timezone.utc) + timedelta(seconds=self.retry_delay)
+                    continue
+                self._retries.pop(name, None)
+                await runner.call(self._save, name, datetime.now(timezone.utc))
+
+    def _save(self, name, last_run):
+        self.last_runs[name] = last_run
+        # BSON datetimes are naive UTC
+        self.collection.update_one(
+            {'name': name}, {'$set': {'last_run': last_run.replace(tzinfo=None)}}, upsert=True
+        )
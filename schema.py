@@ -0,0 +1,164 @@
+import os
+import sys
+from datetime import datetime
+from urllib.parse import urlparse
+
+import pymongo
+
+
+# indexes by collection, as (keys, options)
+INDEXES = {
+    'players': [
+        ([('game', pymongo.ASCENDING), ('id', pymongo.ASCENDING)], {'unique': True, 'name': 'game_id'}),
+        # routing a message when the games of the users aren't kept in memory
+        ([('id', pymongo.ASCENDING)], {'name': 'player_id'}),
+        # pairing: equality on game and status, sort on rounds and storage order, range on last_round
+        (
+            [
+                ('game', pymongo.ASCENDING),
+                ('status', pymongo.ASCENDING),
+                ('rounds', pymongo.ASCENDING),
+                ('_id', pymongo.ASCENDING),
+                ('last_round', pymongo.ASCENDING)
+            ],
+            {'name': 'game_pairing'}
+        ),
+        # leaderboard: the top points of a game
+        (
+            [('game', pymongo.ASCENDING), ('points', pymongo.DESCENDING), ('name', pymongo.ASCENDING)],
+            {'name': 'game_points_name'}
+        ),
+    ],
+    'games': [
+        ([('channel_id', pymongo.ASCENDING)], {'unique': True, 'name': 'channel_id'}),
+    ],
+    'conversations': [
+        ([('key', pymongo.ASCENDING)], {'unique': True, 'name': 'key'}),
+    ],
+    'schedule': [
+        ([('name', pymongo.ASCENDING)], {'unique': True, 'name': 'name'}),
+    ],
+    'leases': [
+        ([('name', pymongo.ASCENDING)], {'unique': True, 'name': 'name'}),
+    ],
+    'events': [
+        (
+            [('partition', pymongo.ASCENDING), ('owner', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+            {'name': 'partition'}
+        ),
+    ],
+    'templates': [
+        (
+            [('name', pymongo.ASCENDING), ('language', pymongo.ASCENDING), ('game', pymongo.ASCENDING)],
+            {'unique': True, 'name': 'override'}
+        ),
+    ],
+    'broadcasts': [
+        # the workers read them within a poll, an hour covers a worker stalled for a while
+        ([('created', pymongo.ASCENDING)], {'expireAfterSeconds': 60 * 60, 'name': 'created'}),
+    ],
+    'handled_events': [
+        # replays come within minutes, a day of keys is plenty
+        ([('seen_at', pymongo.ASCENDING)], {'expireAfterSeconds': 24 * 60 * 60, 'name': 'seen_at'}),
+    ],
+}
+# indexes of the single game data model, and the leaderboard index ordering ties by _id
+OBSOLETE_INDEXES = {
+    'players': ['id', 'pairing', 'game_points'],
+}
+
+
+def hot_queries():
+    '''
+        Returns the frequent queries of app.py as (collection, filter, sort) tuples.
+    '''
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        ('players', {'game': 'C0', 'id': 'U0'}, None),
+        ('players', {'game': 'C0', 'id': {'$in': ['U0', 'U1']}}, None),
+        ('players', {'game': {'$in': ['C0', 'C1']}, 'id': 'U0'}, None),
+        ('players', {'id': 'U0'}, None),
+        ('players', {'game': 'C0', 'status': 'ready', 'last_round': {'$ne': today}}, [('rounds', 1), ('_id', 1)]),
+        ('players', {'game': 'C0'}, [('points', -1), ('name', 1)]),
+        ('games', {'channel_id': 'C0'}, None),
+        ('conversations', {'key': 'U0,U1'}, None),
+        ('events', {'partition': 0, 'owner': None}, [('_id', 1)]),
+    ]
+
+
+def migrate(db):
+    '''
+        Moves the game of the single game data model (settings collection) into the games collection.
+    '''
+    settings = {setting['name']: setting['value'] for setting in db['settings'].find()}
+    if settings.get('channel_id') is not None:
+        channel_id = settings['channel_id']
+        # a pending confirmation can't be answered after the move, it lost its admin
+        status = settings.get('status', 'wait')
+        status = {'confirm_start': 'wait', 'confirm_stop': 'game'}.get(status, status)
+        db['games'].update_one(
+            {'channel_id': channel_id},
+            {
+                '$setOnInsert': {
+                    'channel_name': settings.get('channel_name'),
+                    'status': status,
+                    'version': 1,
+                    'admin': None
+                }
+            },
+            upsert=True
+        )
+        db['players'].update_many({'game': {'$exists': False}}, {'$set': {'game': channel_id}})
+    db['settings'].drop()
+
+
+def ensure_indexes(db):
+    '''
+        Creates the missing indexes and drops the obsolete ones, existing ones are left untouched.
+    '''
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = db[collection].index_information()
+        for name in names:
+            if name in existing:
+                db[collection].drop_index(name)
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            db[collection].create_index(keys, **options)
+
+
+def _stages(plan):
+    yield plan.get('stage')
+    for key in ('inputStage', 'outerStage', 'innerStage'):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from _stages(child)
+
+
+def collection_scans(db):
+    '''
+        Explains the hot queries and returns the ones whose winning plan scans the whole collection.
+
+            :rtype: list
+    '''
+    scans = []
+    for collection, query, sort in hot_queries():
+        cursor = db[collection].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _stages(plan):
+            scans.append((collection, query, sort))
+    return scans
+
+
+if __name__ == "__main__":
+    mongodb_uri = os.environ.get('MONGODB_URI')
+    db = pymongo.MongoClient(mongodb_uri)[urlparse(mongodb_uri).path[1:]]
+
+    migrate(db)
+    ensure_indexes(db)
+    scans = collection_scans(db)
+    for collection, query, sort in scans:
+        print('COLLSCAN in {}: {} sorted by {}'.format(collection, query, sort))
+    sys.exit(1 if scans else 0)
@@ -0,0 +1,392 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+
+class PlayerUnitOfWork:
+    '''
+        Per-event snapshot of the player documents of one game.
+
+        Every involved player is loaded once, the handlers read and modify the in-memory documents and the
+        accumulated $set/$inc/$push changes are written back with a single bulk_write by flush().
+
+        A handler can make the changes of a player conditional with expect(). When the stored player doesn't match
+        anymore, because a duplicate of the event was handled first, none of the changes are written.
+
+            :param collection: the players collection
+            :type collection: pymongo.collection.Collection
+            :param game_id: the channel id of the game
+            :type game_id: str
+    '''
+
+    def __init__(self, collection, game_id):
+        self.collection = collection
+        self.game_id = game_id
+        self._players = {}
+        self._updates = OrderedDict()
+        self._conditions = {}
+        self._after_flush = []
+        self.stale = False
+
+    def load(self, *user_ids):
+        missing = [user_id for user_id in user_ids if user_id not in self._players]
+        if len(missing) == 1:
+            self._players[missing[0]] = self.collection.find_one({'game': self.game_id, 'id': missing[0]})
+        elif len(missing) > 1:
+            for user_id in missing:
+                self._players[user_id] = None
+            for player in self.collection.find({'game': self.game_id, 'id': {'$in': missing}}):
+                self._players[player['id']] = player
+
+    def add(self, player):
+        '''
+            Adds an already loaded player document to the snapshot.
+        '''
+        self._players.setdefault(player['id'], player)
+
+    def get(self, user_id):
+        '''
+            Returns the player document or None if the user is not a player.
+        '''
+        self.load(user_id)
+        return self._players[user_id]
+
+    def __getitem__(self, user_id):
+        player = self.get(user_id)
+        if player is None:
+            raise KeyError(user_id)
+        return player
+
+    def expect(self, user_id, conditions):
+        '''
+            Writes the changes of the player only if the stored document still matches the query conditions.
+        '''
+        self._conditions.setdefault(user_id, {}).update(conditions)
+
+    def after_flush(self, callback):
+        '''
+            Calls the callback once the changes are written, it is dropped with the changes of a stale snapshot.
+        '''
+        self._after_flush.append(callback)
+
+    def set(self, user_id, fields):
+        player = self[user_id]
+        update = self._update(user_id)
+        for key, value in fields.items():
+            player[key] = value
+            update['$inc'].pop(key, None)
+            update['$push'].pop(key, None)
+            update['$set'][key] = value
+
+    def inc(self, user_id, fields):
+        player = self[user_id]
+        update = self._update(user_id)
+        for key, value in fields.items():
+            player[key] = player.get(key, 0) + value
+            if key in update['$set']:
+                # mongo refuses $set and $inc on the same path, so fold it into the $set
+                update['$set'][key] = player[key]
+            else:
+                update['$inc'][key] = update['$inc'].get(key, 0) + value
+
+    def push(self, user_id, fields):
+        player = self[user_id]
+        update = self._update(user_id)
+        for key, value in fields.items():
+            player.setdefault(key, []).append(value)
+            if key in update['$set']:
+                update['$set'][key] = player[key]
+            else:
+                update['$push'].setdefault(key, {'$each': []})['$each'].append(value)
+
+    def flush(self):
+        '''
+            Writes the accumulated changes in one bulk_write, the conditional changes go first in a bulk_write of
+            their own.
+
+                :return: False if a condition didn't match, the snapshot is stale and nothing is written anymore
+                :rtype: bool
+        '''
+        guarded = []
+        requests = []
+        for user_id, update in self._updates.items():
+            update = {operator: fields for operator, fields in update.items() if fields}
+            if update:
+                query = {'game': self.game_id, 'id': user_id}
+                if user_id in self._conditions:
+                    query.update(self._conditions[user_id])
+                    guarded.append(UpdateOne(query, update))
+                else:
+                    requests.append(UpdateOne(query, update))
+        self._updates.clear()
+        self._conditions.clear()
+        callbacks, self._after_flush = self._after_flush, []
+        if self.stale:
+            return False
+
+        if guarded and self.collection.bulk_write(guarded, ordered=True).matched_count < len(guarded):
+            self.stale = True
+            return False
+        if requests:
+            self.collection.bulk_write(requests, ordered=True)
+        for callback in callbacks:
+            callback()
+        return True
+
+    def _update(self, user_id):
+        if user_id not in self._updates:
+            self._updates[user_id] = {'$set': {}, '$inc': {}, '$push': {}}
+        return self._updates[user_id]
+
+
+class GameState:
+    '''
+        In-memory copy of a game document (status, channel id, channel name and schedule).
+
+        The game is loaded once and every change is written through to the games collection. Status changes must
+        follow TRANSITIONS and are guarded by a version field, so when another worker changed the status in the
+        meantime the write is refused and the state is reloaded instead.
+
+            :param collection: the games collection
+            :type collection: pymongo.collection.Collection
+            :param channel_id: the id of the channel the game is played in, it identifies the game
+            :type channel_id: str
+
+        The schedule is set in the game document: daily_hour and timezone (an IANA name) of the daily pairing,
+        duration_days after which a started game ends and repeat_days after which an ended game starts again.
+        The language of the messages of the game is set there as well (see templates.py).
+    '''
+
+    # the scheduler ends and restarts games without confirmation
+    TRANSITIONS = {
+        'wait': ('confirm_start', 'game'),
+        'confirm_start': ('game', 'wait'),
+        'game': ('confirm_stop', 'wait'),
+        'confirm_stop': ('wait', 'game'),
+    }
+
+    def __init__(self, collection, channel_id, channel_name=None):
+        self.collection = collection
+        self.channel_id = channel_id
+        self.channel_name = channel_name
+        self.status = 'wait'
+        self.version = 0
+        # the admin who asked for the pending confirmation
+        self.admin = None
+        self.started_at = None
+        self.ended_at = None
+        self.daily_hour = None
+        self.timezone = None
+        self.duration_days = None
+        self.repeat_days = None
+        self.language = None
+
+    def load(self, game=None):
+        if game is None:
+            game = self.collection.find_one({'channel_id': self.channel_id})
+        if game is None:
+            return
+        self.channel_name = game.get('channel_name', self.channel_name)
+        self.status = game['status']
+        self.version = game.get('version', 0)
+        self.admin = game.get('admin')
+        if game.get('started_at') is not None:
+            self.started_at = game['started_at'].replace(tzinfo=timezone.utc)
+        if game.get('ended_at') is not None:
+            self.ended_at = game['ended_at'].replace(tzinfo=timezone.utc)
+        self.daily_hour = game.get('daily_hour')
+        self.timezone = game.get('timezone')
+        self.duration_days = game.get('duration_days')
+        self.repeat_days = game.get('repeat_days')
+        self.language = game.get('language')
+
+    def tzinfo(self):
+        '''
+            Returns the time zone of the game, None for the local time.
+        '''
+        return ZoneInfo(self.timezone) if self.timezone else None
+
+    def deadline(self):
+        '''
+            Returns when the running game ends, None if it runs until it is stopped.
+        '''
+        if self.started_at is None or not self.duration_days:
+            return None
+        return self.started_at + timedelta(days=self.duration_days)
+
+    def next_start(self):
+        '''
+            Returns when the game starts again, None if it isn't recurring.
+
+            The game keeps its rhythm (repeat_days after its last start) unless it ended after that time, because it
+            was stopped late or runs longer than repeat_days. Then it starts again repeat_days after its end, so a
+            stopped game never restarts right away.
+        '''
+        if self.started_at is None or not self.repeat_days:
+            return None
+        repeat = timedelta(days=self.repeat_days)
+        next_start = self.started_at + repeat
+        if self.ended_at is not None:
+            if next_start <= self.ended_at:
+                next_start = self.ended_at + repeat
+        else:
+            # games ended before the end was recorded skip the starts that passed
+            now = datetime.now(timezone.utc)
+            while next_start <= now:
+                next_start += repeat
+        return next_start
+
+    def transition(self, status, admin=None, started_at=None, ended_at=None):
+        '''
+            Moves the game to a new status.
+
+                :param status: the new status
+                :type status: str
+                :param admin: the admin who has to confirm the new status
+                :type admin: str
+                :param started_at: the start of the game, when the game starts
+                :type started_at: datetime.datetime
+                :param ended_at: the end of the game, when the game ends
+                :type ended_at: datetime.datetime
+                :return: False if another worker changed the status first
+                :rtype: bool
+        '''
+        if status not in self.TRANSITIONS[self.status]:
+            raise ValueError('Invalid status transition!', self.status, status)
+
+        update = {
+            '$set': {
+                'channel_name': self.channel_name,
+                'status': status,
+                'version': self.version + 1,
+                'admin': admin
+            }
+        }
+        if started_at is not None:
+            # BSON datetimes are naive UTC
+            update['$set']['started_at'] = started_at.astimezone(timezone.utc).replace(tzinfo=None)
+        if ended_at is not None:
+            update['$set']['ended_at'] = ended_at.astimezone(timezone.utc).replace(tzinfo=None)
+        if self.version == 0:
+            # the first transition creates the game document
+            try:
+                result = self.collection.update_one(
+                    {'channel_id': self.channel_id, 'version': {'$in': [0, None]}}, update, upsert=True
+                )
+            except DuplicateKeyError:
+                self.load()
+                return False
+        else:
+            result = self.collection.update_one(
+                {'channel_id': self.channel_id, 'status': self.status, 'version': self.version}, update
+            )
+        if result.matched_count == 0 and result.upserted_id is None:
+            self.load()
+            return False
+
+        self.status = status
+        self.version += 1
+        self.admin = admin
+        if started_at is not None:
+            self.started_at = started_at
+        if ended_at is not None:
+            self.ended_at = ended_at
+        return True
+
+
+class GameRegistry:
+    '''
+        The games by channel id and the games of every user.
+
+        Messages are routed to a game through the user's games, so a message costs one player query over the few
+        games of the user instead of a scan over every game. When other workers change the games as well (shared),
+        the games of the user are looked up by the indexed player id instead.
+
+            :param db: the database
+            :type db: pymongo.database.Database
+    '''
+
+    def __init__(self, db, shared=False):
+        self.db = db
+        self.shared = shared
+        self.games = {}
+        self._user_games = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        self.load_games()
+        user_games = {}
+        for player in self.db['players'].find({}, {'id': True, 'game': True}):
+            user_games.setdefault(player['id'], []).append(player['game'])
+        with self._lock:
+            self._user_games = user_games
+
+    def load_games(self):
+        games = {}
+        for game in self.db['games'].find():
+            games[game['channel_id']] = GameState(self.db['games'], game['channel_id'])
+            games[game['channel_id']].load(game)
+        with self._lock:
+            self.games = games
+
+    def get(self, channel_id, channel_name=None):
+        '''
+            Returns the game of the channel, a new game is only saved at its first status change.
+        '''
+        with self._lock:
+            if channel_id not in self.games:
+                self.games[channel_id] = GameState(self.db['games'], channel_id, channel_name)
+            return self.games[channel_id]
+
+    def with_status(self, *statuses):
+        return [game for game in list(self.games.values()) if game.status in statuses]
+
+    def pending_confirmation(self, admin):
+        '''
+            Returns the game waiting for the confirmation of the admin.
+        '''
+        for game in self.with_status('confirm_start', 'confirm_stop'):
+            if game.admin == admin:
+                return game
+        return None
+
+    def add_players(self, channel_id, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                games = self._user_games.setdefault(user_id, [])
+                if channel_id not in games:
+                    games.append(channel_id)
+
+    def find_player(self, user_id, channel_id):
+        '''
+            Finds the game a message of the user belongs to.
+
+            In the game's mpim the game playing there is chosen, otherwise the game waiting for the user's input.
+
+                :return: the player document or None
+                :rtype: dict
+        '''
+        if self.shared:
+            players = list(self.db['players'].find({'id': user_id}))
+        else:
+            games = self._user_games.get(user_id)
+            if not games:
+                return None
+            if len(games) == 1:
+                return self.db['players'].find_one({'game': games[0], 'id': user_id})
+            players = list(self.db['players'].find({'game': {'$in': games}, 'id': user_id}))
+
+        for player in players:
+            if player['play_channel'] == channel_id and player['status'] == 'answer':
+                return player
+        for player in players:
+            if player['play_channel'] == channel_id:
+                return player
+        for status in ('setup', 'answer', 'play', 'ready'):
+            for player in players:
+                if player['status'] == status:
+                    return player
+        return players[0] if players else None
@@ -0,0 +1,175 @@
+import json
+import string
+import threading
+import time
+
+
+class Template:
+    '''
+        A message template in str.format syntax, parsed once when it is loaded.
+
+        The fields are known after parsing, so a template whose fields don't match its default is refused at
+        load time instead of failing on a send. A template without fields is formatted once, when it is parsed.
+
+            :param text: the template
+            :type text: str
+    '''
+
+    __slots__ = ('text', 'fields', '_format', '_text')
+
+    def __init__(self, text):
+        self.text = text
+        # raises ValueError on unbalanced braces
+        self.fields = frozenset(field for _, field, _, _ in string.Formatter().parse(text) if field is not None)
+        if '' in self.fields or any(field.isdigit() for field in self.fields):
+            raise ValueError('Positional fields are not supported!', text)
+        # the escaped braces of a template without fields still have to be unescaped
+        self._format = text.format if self.fields else None
+        self._text = text.format() if self._format is None else None
+
+    def render(self, **values):
+        return self._text if self._format is None else self._format(**values)
+
+    def render_lines(self, rows, separator='\n', empty='-'):
+        '''
+            Renders the template for every row (a dict of values) and joins the lines, for lists of any length.
+        '''
+        lines = [self._format(**row) for row in rows] if self._format is not None else [self._text for _ in rows]
+        return separator.join(lines) if lines else empty
+
+
+def to_blocks(text):
+    '''
+        Returns a rendered message as a Block Kit payload, one section per paragraph.
+
+            :rtype: str
+    '''
+    return json.dumps([
+        {'type': 'section', 'text': {'type': 'mrkdwn', 'text': paragraph}}
+        for paragraph in text.split('\n\n') if paragraph.strip()
+    ])
+
+
+class Templates:
+    '''
+        The message templates of the bot with their overrides.
+
+        The defaults are given in code. Overrides are stored in Mongo as documents with name, text and optionally
+        language and game (a channel id). A message of a game is rendered from the override of the game, then
+        from the override of the game's language, then from the default. Every template is compiled once by
+        load(), rendering only looks up the compiled template in memory.
+
+            :param collection: the template overrides
+            :type collection: pymongo.collection.Collection
+            :param defaults: the default template texts by name
+            :type defaults: dict
+            :param language_of: returns the language of a game, None for the defaults
+            :type language_of: callable
+    '''
+
+    def __init__(self, collection, defaults, language_of=lambda game_id: None, log=None):
+        self.collection = collection
+        self.language_of = language_of
+        self.log = log
+        self.defaults = {name: Template(text) for name, text in defaults.items()}
+        self._overrides = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''
+            Compiles the overrides stored in Mongo, the ones that can't be used are logged and skipped.
+        '''
+        overrides = {}
+        for document in self.collection.find():
+            name = document.get('name')
+            try:
+                template = Template(document['text'])
+                if name not in self.defaults:
+                    raise ValueError('Unknown template!', name)
+                unknown = template.fields - self.defaults[name].fields
+                if unknown:
+                    raise ValueError('Unknown fields!', name, sorted(unknown))
+            except (KeyError, ValueError) as e:
+                if self.log is not None:
+                    self.log('TEMPLATES', 'Override {} skipped: {}'.format(document.get('_id'), e))
+                continue
+            overrides[(name, document.get('language'), document.get('game'))] = template
+        with self._lock:
+            self._overrides = overrides
+
+    def get(self, name, game_id=None):
+        '''
+            Returns the compiled template used for the messages of the game.
+
+                :rtype: Template
+        '''
+        overrides = self._overrides
+        if overrides:
+            if game_id is not None:
+                template = overrides.get((name, None, game_id))
+                if template is not None:
+                    return template
+                language = self.language_of(game_id)
+                if language is not None:
+                    template = overrides.get((name, language, game_id)) or overrides.get((name, language, None))
+                    if template is not None:
+                        return template
+            template = overrides.get((name, None, None))
+            if template is not None:
+                return template
+        return self.defaults[name]
+
+    def render(self, name, game_id=None, **values):
+        return self.get(name, game_id).render(**values)
+
+    def render_lines(self, name, rows, game_id=None, **kwargs):
+        return self.get(name, game_id).render_lines(rows, **kwargs)
+
+    def stats(self):
+        return {'defaults': len(self.defaults), 'overrides': len(self._overrides)}
+
+
+if __name__ == '__main__':
+    # benchmark: rendering compared to formatting the constant, with and without overrides
+    class _Overrides:
+        def __init__(self, documents):
+            self.documents = documents
+
+        def find(self):
+            return iter(self.documents)
+
+    text = '@{user_name}: The {number} question is: {question}\nIs it true or false?'
+    line = '{rank}. @{name}: {points} points'
+    values = {'user_name': 'player', 'number': 'second', 'question': 'Is a hash map lookup O(1) on average?'}
+    rows = [{'rank': rank, 'name': 'player{}'.format(rank), 'points': 30 - rank} for rank in range(1, 11)]
+    templates = Templates(
+        _Overrides([
+            {
+                '_id': 1,
+                'name': 'round_question',
+                'language': 'hu',
+                'text': '@{user_name}: A(z) {number} kérdés: {question}\nIgaz vagy hamis?'
+            },
+            {'_id': 2, 'name': 'round_question', 'game': 'C1', 'text': '{user_name}, {number}: {question}'}
+        ]),
+        {'round_question': text, 'leaderboard_line': line},
+        language_of=lambda game_id: 'hu' if game_id == 'C2' else None
+    )
+    plain = Templates(_Overrides([]), {'round_question': text})
+    templates.load()
+    plain.load()
+    cases = [
+        ('str.format', lambda: text.format(**values)),
+        ('no overrides', lambda: plain.render('round_question', 'C0', **values)),
+        ('default', lambda: templates.render('round_question', 'C0', **values)),
+        ('game override', lambda: templates.render('round_question', 'C1', **values)),
+        ('language', lambda: templates.render('round_question', 'C2', **values)),
+        ('10 line list', lambda: templates.render_lines('leaderboard_line', rows, 'C0')),
+    ]
+    rounds = 100000
+    for name, render in cases:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            render()
+        elapsed = time.perf_counter() - started
+        print('{:<14} {:6.2f} us per message'.format(name, elapsed / rounds * 1e6))
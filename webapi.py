@@ -0,0 +1,134 @@
+import json
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from slackclient._slackrequest import SlackRequest
+
+from messaging import RateLimiter
+
+
+# error responses worth another try, the others won't change by repeating the call
+RETRYABLE_ERRORS = (
+    'ratelimited', 'internal_error', 'fatal_error', 'service_unavailable', 'request_timeout', 'connection_error',
+    'request_failed'
+)
+# methods that must not run twice, they are retried only when the request surely didn't reach Slack
+NOT_IDEMPOTENT_METHODS = ('chat.postMessage', 'chat.postEphemeral', 'chat.meMessage')
+# failures of those methods before the request was sent: rate limited or couldn't connect
+UNSENT_ERRORS = ('ratelimited', 'connection_error')
+
+
+class PooledRequester(SlackRequest):
+    '''
+        SlackRequest reusing keep-alive connections from a pool instead of opening a new connection for every call.
+
+            :param pool_size: the number of connections kept open, should cover the concurrent calls
+            :type pool_size: int
+    '''
+
+    def __init__(self, pool_size=16, proxies=None):
+        super().__init__(proxies=proxies)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def do(self, token, request='?', post_data=None, domain='slack.com', timeout=None):
+        post_data = dict(post_data or {})
+        files = None
+        if request == 'files.upload' and 'file' in post_data:
+            files = {'file': post_data.pop('file')}
+        for key, value in post_data.items():
+            if not isinstance(value, str):
+                post_data[key] = json.dumps(value)
+        post_data['token'] = token
+        return self.session.post(
+            'https://{}/api/{}'.format(domain, request),
+            headers={'user-agent': self.get_user_agent()},
+            data=post_data,
+            files=files,
+            timeout=timeout,
+            proxies=self.proxies
+        )
+
+
+class WebClient:
+    '''
+        Slack Web API client retrying the transient failures.
+
+        Rate limited calls wait for the Retry-After of the response, server errors, timeouts and connection errors
+        are retried with exponential backoff and full jitter, so the threads hitting the same failure don't retry
+        in lockstep. A message could already be posted when its response fails, so the methods of
+        NOT_IDEMPOTENT_METHODS are retried only when rate limited or when the connection couldn't be made. After
+        max_retries the failure is returned (api_call) or raised (call) as before.
+
+            :param slack_client: the Slack client, its requester sends the calls
+            :type slack_client: slackclient.SlackClient
+            :param limiter: throttles the calls by method, no throttling if None
+            :type limiter: messaging.RateLimiter
+            :param metrics: counts the error responses, optional
+            :type metrics: metrics.Metrics
+    '''
+
+    def __init__(self, slack_client, limiter=None, max_retries=4, backoff=0.5, max_backoff=30.0, timeout=10.0,
+                 metrics=None):
+        self.slack_client = slack_client
+        self.limiter = limiter if limiter is not None else RateLimiter(limits={}, default=None)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.metrics = metrics
+
+    def api_call(self, method, **kwargs):
+        '''
+            Calls a Web API method, as SlackClient.api_call.
+
+                :return: the response, an error response when the call failed for good
+                :rtype: dict
+        '''
+        retryable = UNSENT_ERRORS if method in NOT_IDEMPOTENT_METHODS else RETRYABLE_ERRORS
+        attempt = 0
+        while True:
+            self.limiter.acquire(method)
+            try:
+                response = self.slack_client.server.api_requester.do(
+                    self.slack_client.token, method, dict(kwargs), timeout=self.timeout
+                )
+            except requests.ConnectionError as e:
+                # ConnectTimeout included, the request wasn't sent
+                api_call = {'ok': False, 'error': 'connection_error', 'args': str(e)}
+            except requests.RequestException as e:
+                # ReadTimeout and the like, the request could have been handled
+                api_call = {'ok': False, 'error': 'request_failed', 'args': str(e)}
+            else:
+                if response.status_code == 429:
+                    # every thread waits until Retry-After has passed
+                    self.limiter.pause(float(response.headers.get('Retry-After', 1)))
+                    api_call = {'ok': False, 'error': 'ratelimited'}
+                elif response.status_code >= 500:
+                    api_call = {'ok': False, 'error': 'service_unavailable', 'args': response.status_code}
+                else:
+                    api_call = json.loads(response.text)
+
+            if api_call.get('ok'):
+                return api_call
+            if api_call.get('error') not in retryable or attempt >= self.max_retries:
+                if self.metrics is not None:
+                    self.metrics.count_api_error(method, api_call.get('error'))
+                return api_call
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            attempt += 1
+
+    def call(self, method, **kwargs):
+        '''
+            Calls a Web API method.
+
+                :return: the response
+                :rtype: dict
+                :raises ValueError: when the response is an error
+        '''
+        api_call = self.api_call(method, **kwargs)
+        if api_call.get('ok'):
+            return api_call
+        raise ValueError('Connection error!', api_call.get('error'), api_call.get('args'))